@@ -0,0 +1,479 @@
+""" date_tools.py
+
+Fast partial-string date lookups on sorted datetime indexes
+
+`prc.loc['2020-01']` parses the string and works out its resolution on
+every call. Here the string is parsed once into [start_ns, end_ns) bounds
+(kept in an LRU cache), and `DateLocator` maps month-aligned bounds such as
+'2020' or '2020-01' to row positions with a precomputed table of the first
+row of each month, so a lookup is two array reads.
+
+`parse_iso` converts columns of fixed-width ISO dates ('2020-09-23') and
+timestamps ('2020-09-23 08:58:55') with NumPy arithmetic on the character
+codes, and only passes the rows it cannot validate to `pd.to_datetime`.
+
+`date_buckets` replaces `df.index.strftime('%Y-%m-%d')` grouping keys with
+integer day, week, month or year numbers, so groupbys on them (and on
+categorical columns) never touch strings. `render_buckets` turns them into
+strings for display, formatting each distinct bucket once.
+"""
+import functools
+import time
+
+import numpy as np
+import pandas as pd
+
+# Number of keys kept by the LRU caches
+MAXSIZE = 4096
+
+
+@functools.lru_cache(maxsize=MAXSIZE)
+def parse_bounds(key):
+    """ Returns the half-open bounds [start_ns, end_ns) covered by `key`:
+
+        '2020'          --> [2020-01-01, 2021-01-01)
+        '2020-01'       --> [2020-01-01, 2020-02-01)
+        '2020-01-01'    --> [2020-01-01, 2020-01-02)
+
+        Other keys (timestamps) cover a single nanosecond
+    """
+    if isinstance(key, str):
+        per = pd.Period(key)
+        return (per.start_time.as_unit('ns').value,
+                (per + 1).start_time.as_unit('ns').value)
+    start = pd.Timestamp(key).as_unit('ns').value
+    return start, start + 1
+
+
+def _month_of(ns):
+    """ Returns the month number (months since 1970-01) of `ns` if `ns` is
+        the first instant of a month, and None otherwise
+    """
+    month = np.datetime64(ns, 'ns').astype('datetime64[M]')
+    if month.astype('datetime64[ns]').astype(np.int64) != ns:
+        return None
+    return int(month.astype(np.int64))
+
+
+class DateLocator:
+    """ Resolves partial date strings to row positions in a sorted,
+        timezone-naive datetime index.
+
+        Usage:
+
+            loc = DateLocator(prc.index)
+            prc.iloc[slice(*loc.positions('2020-01'))]
+            loc.loc(prc, '2020')                   # rows in 2020
+            loc.loc(prc, slice('2020-01-01', '2020-01-05'))
+    """
+
+    def __init__(self, index, maxsize=MAXSIZE):
+        index = pd.DatetimeIndex(index)
+        if index.tz is not None:
+            raise ValueError('The index must be timezone-naive')
+        if not index.is_monotonic_increasing:
+            raise ValueError('The index must be sorted')
+        self.values = index.as_unit('ns').asi8
+        # Position of the first row on or after the start of each month,
+        # from the month of the first row to the month after the last row
+        if len(self.values):
+            months = self.values[[0, -1]].view('datetime64[ns]') \
+                .astype('datetime64[M]').astype(np.int64)
+            self.first_month = int(months[0])
+            starts = np.arange(months[0], months[1] + 2) \
+                .astype('datetime64[M]').astype('datetime64[ns]') \
+                .astype(np.int64)
+            self.month_pos = self.values.searchsorted(starts, side='left')
+        else:
+            self.first_month = 0
+            self.month_pos = np.zeros(1, dtype=np.int64)
+        self._cached = functools.lru_cache(maxsize=maxsize)(self._positions)
+
+    def _pos(self, ns):
+        """ Returns the position of the first row at or after `ns`
+        """
+        month = _month_of(ns)
+        if month is None:
+            return int(self.values.searchsorted(ns, side='left'))
+        k = month - self.first_month
+        if k <= 0:
+            return int(self.month_pos[0]) if k == 0 else 0
+        if k >= len(self.month_pos):
+            return len(self.values)
+        return int(self.month_pos[k])
+
+    def _positions(self, key):
+        start, end = parse_bounds(key)
+        return self._pos(start), self._pos(end)
+
+    def positions(self, key):
+        """ Returns (i, j) such that `df.iloc[i:j]` holds the rows in the
+            period covered by the partial date string (or timestamp) `key`.
+            Keys outside the index give an empty range (i == j)
+        """
+        return self._cached(key)
+
+    def slice_positions(self, start=None, end=None):
+        """ Returns (i, j) such that `df.iloc[i:j]` holds the rows from the
+            start of the `start` period to the end of the `end` period, as
+            in `df.loc[start:end]`
+        """
+        i = 0 if start is None else self._cached(start)[0]
+        j = len(self.values) if end is None else self._cached(end)[1]
+        return i, max(i, j)
+
+    def loc(self, df, key):
+        """ Returns the rows of `df` (which has the index used to build the
+            locator) in the period of `key`, a partial date string or a
+            slice of them. Unlike `df.loc[key]`, the result is always a
+            positional slice of `df`: a key outside the index gives an empty
+            frame instead of a KeyError, and a day on a daily index gives a
+            one-row frame instead of a series
+        """
+        if isinstance(key, slice):
+            i, j = self.slice_positions(key.start, key.stop)
+        else:
+            i, j = self.positions(key)
+        return df.iloc[i:j]
+
+    def cache_info(self):
+        """ Hits and misses of the positions cache
+        """
+        return self._cached.cache_info()
+
+
+# ----------------------------------------------------------------------------
+#   ISO date parsing
+# ----------------------------------------------------------------------------
+# Rows converted at a time, to bound the size of the temporary arrays
+PARSE_CHUNK = 1_000_000
+
+# Columns of the digits and separators in 'YYYY-MM-DD HH:MM:SS'
+_DIGIT_COLS = [0, 1, 2, 3, 5, 6, 8, 9, 11, 12, 14, 15, 17, 18]
+_DATE_DIGITS = 8
+
+
+def _char_codes(values):
+    """ Returns a 2-D unsigned array with the character codes of `values`
+        (one row per value, padded with zeros). ASCII strings are converted
+        to bytes, which makes the array four times smaller than str codes
+    """
+    if values.dtype.kind == 'O':
+        # A fixed width is much faster than finding the longest value.
+        # Longer values are cut, but their 20th character is kept, so they
+        # fail validation and go to the fallback with their full text
+        try:
+            values = values.astype('S20')
+        except UnicodeEncodeError:
+            values = values.astype('U20')
+    if values.dtype.kind == 'S':
+        return values.view(np.uint8).reshape(len(values), -1)
+    return values.view(np.uint32).reshape(len(values), -1)
+
+
+def _days_from_civil(year, month, day):
+    """ Returns the number of days since 1970-01-01 of the given dates
+        (proleptic Gregorian calendar, integer arithmetic only)
+    """
+    year = year - (month <= 2)
+    era = year // 400
+    yoe = year - era * 400
+    doy = (153 * ((month + 9) % 12) + 2) // 5 + day - 1
+    doe = yoe * 365 + yoe // 4 - yoe // 100 + doy
+    return era * 146_097 + doe - 719_468
+
+
+# Days in each month (index 0 unused), February of leap years is fixed below
+_MONTH_DAYS = np.array([0, 31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31])
+
+
+def _parse_codes(codes):
+    """ Parses 'YYYY-MM-DD' and 'YYYY-MM-DD HH:MM:SS' (or with 'T') rows of
+        character codes. Returns (int64 ns, valid mask)
+    """
+    nrows, width = codes.shape
+    if width < 10:
+        return np.zeros(nrows, dtype=np.int64), np.zeros(nrows, dtype=bool)
+    has_time = width >= 19
+    cols = _DIGIT_COLS if has_time else _DIGIT_COLS[:_DATE_DIGITS]
+    # Unsigned wrap-around: any non-digit gives a value above 9
+    # One contiguous row per character position is faster to work with
+    digits = np.ascontiguousarray(
+        (codes[:, cols] - codes.dtype.type(ord('0'))).T)
+    is_digit = digits <= 9
+    digits = digits.astype(np.int32)
+
+    year = digits[0] * 1000 + digits[1] * 100 + digits[2] * 10 + digits[3]
+    month = digits[4] * 10 + digits[5]
+    day = digits[6] * 10 + digits[7]
+    leap = (year % 4 == 0) & ((year % 100 != 0) | (year % 400 == 0))
+    # Limits of datetime64[ns], dates outside are left to the fallback
+    ok_date = (year >= 1678) & (year <= 2261) \
+        & is_digit[:_DATE_DIGITS].all(axis=0) \
+        & (codes[:, 4] == ord('-')) & (codes[:, 7] == ord('-')) \
+        & (month >= 1) & (month <= 12) & (day >= 1) \
+        & (day <= _MONTH_DAYS[np.clip(month, 0, 12)]
+           + (leap & (month == 2)))
+    secs = _days_from_civil(year, month, day).astype(np.int64) * 86_400
+    if width == 10:
+        return secs * 10**9, ok_date
+
+    # Shorter values are padded with zeros
+    ok = ok_date & (codes[:, 10:] == 0).all(axis=1)
+    if has_time:
+        hour = digits[8] * 10 + digits[9]
+        minute = digits[10] * 10 + digits[11]
+        second = digits[12] * 10 + digits[13]
+        ok_time = ok_date & is_digit[_DATE_DIGITS:].all(axis=0) \
+            & ((codes[:, 10] == ord(' ')) | (codes[:, 10] == ord('T'))) \
+            & (codes[:, 13] == ord(':')) & (codes[:, 16] == ord(':')) \
+            & (hour < 24) & (minute < 60) & (second < 60)
+        if width > 19:
+            # e.g. fractional seconds, left to the fallback
+            ok_time &= (codes[:, 19:] == 0).all(axis=1)
+        secs += np.where(ok_time, hour * 3_600 + minute * 60 + second, 0)
+        ok |= ok_time
+    return secs * 10**9, ok
+
+
+def parse_iso(values, chunksize=PARSE_CHUNK):
+    """ Same as `pd.to_datetime(values)` for columns of ISO dates
+        ('2020-09-23') and timestamps ('2020-09-23 08:58:55' or with 'T').
+
+        `values` can hold str or bytes (e.g. a fixed-width 'S19' array read
+        from a raw buffer). Rows which are not in one of these formats,
+        including missing values, are parsed by `pd.to_datetime`. Returns a
+        datetime64[ns] Series for a Series input, a DatetimeIndex otherwise.
+        Results are timezone-naive, so values with a UTC offset raise a
+        ValueError (use `pd.to_datetime(values, utc=True)` for them)
+    """
+    index = values.index if isinstance(values, pd.Series) else None
+    name = getattr(values, 'name', None)
+    arr = np.asarray(values)
+    if arr.dtype.kind not in 'SU':
+        arr = arr.astype(object)
+    res = np.empty(len(arr), dtype=np.int64)
+    bad = []
+    for start in range(0, len(arr), chunksize):
+        chunk = arr[start:start + chunksize]
+        # Missing values become 'None' or 'nan' and are left to the fallback
+        ns, ok = _parse_codes(_char_codes(chunk))
+        res[start:start + len(chunk)] = ns
+        if not ok.all():
+            bad.append(start + np.flatnonzero(~ok))
+
+    dates = res.view('datetime64[ns]')
+    if bad:
+        bad = np.concatenate(bad)
+        fallback = arr[bad]
+        if fallback.dtype.kind == 'S':
+            fallback = np.char.decode(fallback)
+        parsed = pd.to_datetime(pd.Index(fallback, dtype=object),
+                                format='mixed')
+        if parsed.tz is not None:
+            raise ValueError(f'Values with a UTC offset are not supported: '
+                             f'{fallback[~parsed.isna()][0]!r}')
+        dates[bad] = parsed.as_unit('ns').to_numpy()
+    if index is not None:
+        return pd.Series(dates, index=index, name=name)
+    return pd.DatetimeIndex(dates, name=name)
+
+
+# ----------------------------------------------------------------------------
+#   Date buckets
+# ----------------------------------------------------------------------------
+# Bucket frequency --> default display format
+BUCKET_FORMATS = {
+    'D': '%Y-%m-%d',
+    'W': '%Y-%m-%d',      # Monday of the week
+    'M': '%Y-%m',
+    'Y': '%Y',
+    }
+
+# Bucket number of missing dates (same value as NaT)
+NA_BUCKET = np.iinfo(np.int64).min
+
+_NS_PER_DAY = 86_400 * 10**9
+
+
+def _check_freq(freq):
+    if freq not in BUCKET_FORMATS:
+        raise ValueError(f'Invalid bucket frequency: {freq}')
+
+
+def date_buckets(values, freq='D'):
+    """ Returns the bucket number of each date in `values` as an int64
+        array: days ('D'), weeks starting on Monday ('W'), months ('M') or
+        years ('Y') since 1970-01-01, computed by integer floor division.
+        Tz-aware dates are bucketed by their local wall time, like
+        `strftime`. Missing dates get NA_BUCKET
+    """
+    _check_freq(freq)
+    index = pd.DatetimeIndex(values)
+    if index.tz is not None:
+        index = index.tz_localize(None)
+    ns = index.as_unit('ns').asi8
+    if freq in ('M', 'Y'):
+        res = ns.view('datetime64[ns]').astype(f'datetime64[{freq}]') \
+            .astype(np.int64)
+    else:
+        res = ns // _NS_PER_DAY
+        if freq == 'W':
+            # 1970-01-01 was a Thursday
+            res = (res + 3) // 7
+    res[ns == NA_BUCKET] = NA_BUCKET
+    return res
+
+
+def bucket_start(codes, freq='D'):
+    """ Returns the first day of each bucket in `codes` as a DatetimeIndex
+    """
+    _check_freq(freq)
+    codes = np.asarray(codes, dtype=np.int64)
+    if freq in ('M', 'Y'):
+        ns = codes.astype(f'datetime64[{freq}]').astype('datetime64[ns]') \
+            .astype(np.int64)
+    elif freq == 'W':
+        ns = (codes * 7 - 3) * _NS_PER_DAY
+    else:
+        ns = codes * _NS_PER_DAY
+    ns[codes == NA_BUCKET] = NA_BUCKET
+    return pd.DatetimeIndex(ns.view('datetime64[ns]'))
+
+
+def bucket_labels(codes, freq='D', fmt=None):
+    """ Returns the bucket numbers in `codes` as strings (object array),
+        formatting each distinct bucket only once
+    """
+    fmt = fmt or BUCKET_FORMATS[freq]
+    pos, uniques = pd.factorize(np.asarray(codes, dtype=np.int64))
+    labels = bucket_start(uniques, freq).strftime(fmt) \
+        .to_numpy(dtype=object, na_value=None)
+    return pd.api.extensions.take(labels, pos, allow_fill=True)
+
+
+def render_buckets(obj, key, freq='D', fmt=None):
+    """ Returns a copy of `obj` (a Series or DataFrame) with the bucket
+        numbers in the index level or column `key` shown as strings
+    """
+    if key in obj.index.names:
+        index = obj.index
+        if isinstance(index, pd.MultiIndex):
+            level = index.names.index(key)
+            labels = bucket_labels(index.levels[level], freq, fmt)
+            index = index.set_levels(labels, level=level)
+        else:
+            index = pd.Index(bucket_labels(index, freq, fmt), name=key)
+        return obj.set_axis(index, axis=0)
+    obj = obj.copy()
+    obj[key] = bucket_labels(obj[key], freq, fmt)
+    return obj
+
+
+# ----------------------------------------------------------------------------
+#   Benchmarks
+# ----------------------------------------------------------------------------
+def bench_date_locator(nqueries=100_000, seed=0):
+    """ Compares `prc.loc[key]` with `DateLocator.loc` for the partial
+        strings used in pd_data.py, on a daily frame from 1990 to 2025
+    """
+    dates = pd.date_range('1990-01-01', '2025-12-31', freq='D')
+    prc = pd.DataFrame({'Close': np.arange(len(dates), dtype=float)},
+                       index=dates)
+    rng = np.random.default_rng(seed)
+    years = rng.integers(1990, 2026, nqueries)
+    months = rng.integers(1, 13, nqueries)
+    keys = [f'{y}' if i % 3 == 0 else f'{y}-{m:02d}'
+            for i, (y, m) in enumerate(zip(years, months))]
+    keys[::5] = [slice(f'{y}-{m:02d}-01', f'{y}-{m:02d}-05')
+                 for y, m in zip(years[::5], months[::5])]
+
+    nchecks = 1_000
+    t0 = time.perf_counter()
+    expected = [len(prc.loc[key]) for key in keys[:nchecks]]
+    t_loc = (time.perf_counter() - t0) / nchecks
+
+    locator = DateLocator(prc.index)
+    t0 = time.perf_counter()
+    res = [len(locator.loc(prc, key)) for key in keys]
+    t_fast = (time.perf_counter() - t0) / nqueries
+
+    t0 = time.perf_counter()
+    for key in keys:
+        if isinstance(key, slice):
+            locator.slice_positions(key.start, key.stop)
+        else:
+            locator.positions(key)
+    t_pos = (time.perf_counter() - t0) / nqueries
+
+    assert res[:nchecks] == expected
+    print(f'prc.loc[key]: {t_loc * 1e6:.1f}us, '
+          f'DateLocator.loc: {t_fast * 1e6:.1f}us, '
+          f'positions only: {t_pos * 1e6:.2f}us per lookup')
+    print(locator.cache_info())
+
+
+def bench_parse_iso(nobs=10_000_000, seed=0):
+    """ Compares `pd.to_datetime` (with and without a format) with
+        `parse_iso` on `nobs` timestamps like the ones in pd_groupby.py
+    """
+    rng = np.random.default_rng(seed)
+    ns = np.datetime64('2020-01-01', 'ns') \
+        + rng.integers(0, 3 * 365 * 86_400, nobs) * np.timedelta64(1, 's')
+    ser = pd.Series(np.datetime_as_string(ns, unit='s')).str.replace('T', ' ')
+    ser = ser.astype(object)
+    print(f'--- {nobs:,} timestamps')
+
+    t0 = time.perf_counter()
+    expected = pd.to_datetime(ser)
+    print(f'pd.to_datetime: {time.perf_counter() - t0:.3f}s')
+
+    t0 = time.perf_counter()
+    pd.to_datetime(ser, format='%Y-%m-%d %H:%M:%S')
+    print(f'pd.to_datetime with format: {time.perf_counter() - t0:.3f}s')
+
+    t0 = time.perf_counter()
+    res = parse_iso(ser)
+    print(f'parse_iso: {time.perf_counter() - t0:.3f}s')
+
+    buf = ser.to_numpy().astype('S19')
+    t0 = time.perf_counter()
+    parse_iso(buf)
+    print(f'parse_iso on bytes: {time.perf_counter() - t0:.3f}s')
+    assert (res.to_numpy() == expected.to_numpy()).all()
+
+
+def bench_date_buckets(nobs=5_000_000, nfirms=5_000):
+    """ Compares the 'event_date' groupby in pd_groupby.py (strftime keys)
+        with integer day buckets and a categorical 'firm' column
+    """
+    from events import make_events
+
+    df = make_events(nobs, nfirms=nfirms)
+    print(f'--- {nobs:,} events, {nfirms:,} firms')
+
+    t0 = time.perf_counter()
+    tmp = df.copy()
+    tmp.loc[:, 'event_date'] = tmp.index.strftime('%Y-%m-%d')
+    expected = tmp.groupby(['event_date', 'firm']).last()
+    print(f'strftime keys: {time.perf_counter() - t0:.3f}s')
+
+    df['firm'] = df['firm'].astype('category')
+    t0 = time.perf_counter()
+    tmp = df.copy()
+    tmp.loc[:, 'event_date'] = date_buckets(tmp.index, 'D')
+    res = tmp.groupby(['event_date', 'firm'], observed=True).last()
+    print(f'integer buckets: {time.perf_counter() - t0:.3f}s')
+
+    t0 = time.perf_counter()
+    res = render_buckets(res, 'event_date', 'D')
+    print(f'rendering the result: {time.perf_counter() - t0:.3f}s')
+    assert res['action'].to_numpy().tolist() \
+        == expected['action'].to_numpy().tolist()
+    assert [(d, str(f)) for d, f in res.index] == list(expected.index)
+
+
+if __name__ == "__main__":
+    bench_date_locator()
+    bench_parse_iso()
+    bench_date_buckets()
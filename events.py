@@ -0,0 +1,205 @@
+""" events.py
+
+Loader for the analyst recommendation (firm/action) event data
+
+The 'firm' and 'action' columns are stored as categoricals. The categories
+of each column come from a shared dictionary persisted under `cfg.DATADIR`,
+so the integer codes are the same across files and runs.
+"""
+import functools
+import json
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+import toolkit_config as cfg
+
+EVENT_CATS_JSON = os.path.join(cfg.DATADIR, 'event_cats.json')
+
+# Columns with labels
+CAT_COLS = ('firm', 'action')
+
+
+# ----------------------------------------------------------------------------
+#   The shared category dictionary
+# ----------------------------------------------------------------------------
+def load_categories(path=EVENT_CATS_JSON):
+    """ Returns the dictionary with column --> list of categories stored in
+        `path`, or an empty dictionary if the file does not exist
+    """
+    if not os.path.exists(path):
+        return {}
+    with open(path) as fobj:
+        return json.load(fobj)
+
+
+def save_categories(cats, path=EVENT_CATS_JSON):
+    """ Stores the dictionary `cats` in `path`
+    """
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as fobj:
+        json.dump(cats, fobj, indent=2)
+    os.replace(tmp_path, path)
+
+
+def _extend_categories(known, values):
+    """ Returns `known` plus the labels in `values` not yet in `known`.
+        New labels are added at the end, so existing codes do not change
+    """
+    labels = pd.unique(pd.Series(values).dropna())
+    seen = set(known)
+    new = [label for label in labels if label not in seen]
+    return list(known) + sorted(new)
+
+
+# ----------------------------------------------------------------------------
+#   Encoding
+# ----------------------------------------------------------------------------
+def encode_events(df, cats, cols=CAT_COLS):
+    """ Converts the columns `cols` of `df` to categoricals using the shared
+        dictionary `cats`. New labels are added to `cats` in place.
+
+        Returns a tuple (df, changed) where `changed` is True if `cats` was
+        modified.
+    """
+    df = df.copy()
+    changed = False
+    for col in cols:
+        values = df[col]
+        is_cat = isinstance(values.dtype, pd.CategoricalDtype)
+        known = cats.get(col, [])
+        # For categoricals, only the categories need to be checked
+        full = _extend_categories(
+            known, values.cat.categories if is_cat else values)
+        if len(full) != len(known):
+            cats[col] = full
+            changed = True
+        if is_cat:
+            df[col] = values.cat.set_categories(full)
+        else:
+            df[col] = pd.Categorical(values, categories=full)
+    return df, changed
+
+
+def read_events(fname, cats_path=EVENT_CATS_JSON, cols=CAT_COLS,
+                date_col='date'):
+    """ Reads the event file `fname` (relative to `cfg.DATADIR`), with the
+        columns in `cols` as categoricals sharing the dictionary stored in
+        `cats_path`. The dictionary is updated if new labels are found.
+    """
+    path = fname if os.path.isabs(fname) else os.path.join(cfg.DATADIR, fname)
+    # Reading as 'category' avoids materializing one string per row
+    df = pd.read_csv(
+        path,
+        dtype={col: 'category' for col in cols},
+        parse_dates=[date_col],
+        index_col=date_col,
+        )
+    cats = load_categories(cats_path)
+    df, changed = encode_events(df, cats, cols=cols)
+    if changed:
+        save_categories(cats, cats_path)
+    return df
+
+
+# ----------------------------------------------------------------------------
+#   Filters
+# ----------------------------------------------------------------------------
+@functools.lru_cache(maxsize=256)
+def _label_table(categories, labels, contains):
+    """ Returns a boolean lookup table with one entry per category, plus a
+        last False entry so that missing values (code -1) are never selected
+    """
+    if contains:
+        keep = [any(label in cat for label in labels) for cat in categories]
+    else:
+        keep = [cat in labels for cat in categories]
+    return np.array(keep + [False], dtype=bool)
+
+
+def label_mask(ser, labels, contains=True):
+    """ Returns a boolean array selecting the rows of `ser` matching any of
+        the labels in `labels`.
+
+        If `contains` is True, a row matches if a label is a substring of its
+        value, like `ser.str.contains('up|down')` for plain labels. Otherwise
+        values must be equal to one of the labels, like `ser.isin(labels)`.
+        Missing values never match.
+
+        The labels are resolved once per set of categories, and the mask is
+        a single lookup on the integer codes.
+    """
+    if isinstance(ser.dtype, pd.CategoricalDtype):
+        codes = ser.cat.codes.to_numpy()
+        categories = ser.cat.categories
+    else:
+        codes, categories = pd.factorize(ser)
+    table = _label_table(tuple(categories), frozenset(labels), contains)
+    return table[codes]
+
+
+# ----------------------------------------------------------------------------
+#   Benchmarks
+# ----------------------------------------------------------------------------
+def make_events(nobs, nfirms=5_000, seed=0):
+    """ Creates a synthetic event table with `nobs` rows and object columns
+    """
+    rng = np.random.default_rng(seed)
+    firms = np.array([f'Firm {i}' for i in range(nfirms)], dtype=object)
+    actions = np.array(['up', 'down', 'main', 'init', 'reit'], dtype=object)
+    start = np.datetime64('2000-01-01', 's').astype(np.int64)
+    data = {
+        'date': pd.to_datetime(
+            start + rng.integers(0, 20 * 365 * 86400, size=nobs), unit='s'),
+        'firm': firms[rng.integers(0, nfirms, size=nobs)],
+        'action': actions[rng.integers(0, len(actions), size=nobs)],
+        }
+    return pd.DataFrame(data=data).set_index('date')
+
+
+def _timeit(func):
+    """ Returns the time in seconds taken by `func()`
+    """
+    t0 = time.perf_counter()
+    func()
+    return time.perf_counter() - t0
+
+
+def bench_events(nobs=10_000_000):
+    """ Compares memory use, groupby and filters with object columns and
+        with categorical columns
+    """
+    raw = make_events(nobs)
+    raw = raw.astype({col: object for col in CAT_COLS})
+    enc, _ = encode_events(raw, {})
+
+    for label, df in (('object', raw), ('category', enc)):
+        mem = df.memory_usage(deep=True).sum() / 2**20
+        t_grp = _timeit(lambda: df.groupby('firm', observed=True).size())
+        t_eq = _timeit(lambda: df.loc[df['action'] == 'up'])
+        t_isin = _timeit(lambda: df.loc[df['action'].isin(['up', 'down'])])
+        print(f'{label:>8}: {mem:8.1f} MB, groupby {t_grp:.3f}s, '
+              f'== filter {t_eq:.3f}s, isin filter {t_isin:.3f}s')
+
+
+def bench_label_mask(nobs=10_000_000):
+    """ Compares `str.contains('up|down')` with `label_mask`
+    """
+    raw = make_events(nobs)
+    enc, _ = encode_events(raw, {})
+
+    t_str = _timeit(lambda: raw['action'].str.contains('up|down'))
+    t_obj = _timeit(lambda: label_mask(raw['action'], ['up', 'down']))
+    t_cat = _timeit(lambda: label_mask(enc['action'], ['up', 'down']))
+    expected = raw['action'].str.contains('up|down').to_numpy(dtype=bool)
+    assert (label_mask(enc['action'], ['up', 'down']) == expected).all()
+    print(f'str.contains:            {t_str:.3f}s')
+    print(f'label_mask (object):     {t_obj:.3f}s')
+    print(f'label_mask (category):   {t_cat:.3f}s')
+
+
+if __name__ == "__main__":
+    bench_events()
+    bench_label_mask()
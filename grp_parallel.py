@@ -0,0 +1,290 @@
+""" grp_parallel.py
+
+Process-pool version of `GroupBy.apply` for CPU-heavy per-group functions
+
+The frame is sorted once by group and its columns are placed in shared
+memory blocks. Each worker attaches to these blocks once and receives only
+(start, end) offsets for its shard of groups, so the frame is never pickled.
+"""
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+import pandas as pd
+
+# State of each worker process, set by `_init_worker`
+_WORKER = {}
+
+
+# ----------------------------------------------------------------------------
+#   Shared memory columns
+# ----------------------------------------------------------------------------
+def _share_array(arr, blocks):
+    """ Copies `arr` to a new shared memory block (appended to `blocks`) and
+        returns (block name, shape, dtype)
+    """
+    arr = np.ascontiguousarray(arr)
+    shm = shared_memory.SharedMemory(create=True, size=max(1, arr.nbytes))
+    blocks.append(shm)
+    np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf)[...] = arr
+    return shm.name, arr.shape, arr.dtype.str
+
+
+def _share_values(values, blocks):
+    """ Returns a spec to rebuild `values` (a column or the index) in a
+        worker. Numeric, bool and datetime values are shared as they are.
+        Other values are shared as integer codes, and only the (usually
+        small) array of unique values is pickled
+    """
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        codes = np.asarray(values.codes if hasattr(values, 'codes')
+                           else values.cat.codes)
+        return ('cat', _share_array(codes, blocks),
+                (values.dtype.categories, values.dtype.ordered))
+    arr = np.asarray(values) if isinstance(values.dtype, np.dtype) else None
+    if arr is not None and arr.dtype.kind in 'biufcmM':
+        return ('raw', _share_array(arr, blocks), None)
+    codes, uniques = pd.factorize(values)
+    return ('codes', _share_array(codes, blocks), uniques)
+
+
+def _attach(spec, blocks):
+    """ Rebuilds the values described by `spec` (see `_share_values`)
+    """
+    kind, (name, shape, dtype), extra = spec
+    shm = shared_memory.SharedMemory(name=name)
+    blocks.append(shm)
+    arr = np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+    if kind == 'raw':
+        return arr
+    if kind == 'cat':
+        categories, ordered = extra
+        return pd.Categorical.from_codes(arr, categories=categories,
+                                         ordered=ordered)
+    return pd.api.extensions.take(extra, arr, allow_fill=True)
+
+
+# ----------------------------------------------------------------------------
+#   Workers
+# ----------------------------------------------------------------------------
+def _init_worker(col_specs, index_spec, index_names, func):
+    """ Attaches to the shared blocks and rebuilds the sorted frame
+    """
+    blocks = []
+    data = {col: _attach(spec, blocks) for col, spec in col_specs}
+    index = _attach(index_spec, blocks)
+    if isinstance(index, pd.MultiIndex):
+        index = index.set_names(index_names)
+    else:
+        index = pd.Index(index, name=index_names[0])
+    _WORKER['blocks'] = blocks
+    _WORKER['df'] = pd.DataFrame(data=data, index=index,
+                                 columns=[col for col, _ in col_specs],
+                                 copy=False)
+    _WORKER['func'] = func
+
+
+def _run_shard(bounds):
+    """ Applies the worker function to each (start, end) group in `bounds`
+    """
+    df = _WORKER['df']
+    func = _WORKER['func']
+    return [func(df.iloc[start:end]) for start, end in bounds]
+
+
+def _shards(starts, ends, nshards):
+    """ Splits the groups into at most `nshards` runs of consecutive groups
+        with about the same number of rows
+    """
+    if len(starts) == 0:
+        return []
+    cum_rows = ends
+    targets = np.linspace(0, cum_rows[-1], nshards + 1)[1:-1]
+    cuts = np.unique(np.searchsorted(cum_rows, targets, side='left') + 1)
+    cuts = cuts[(cuts > 0) & (cuts < len(starts))]
+    edges = np.r_[0, cuts, len(starts)]
+    return [list(zip(starts[a:b].tolist(), ends[a:b].tolist()))
+            for a, b in zip(edges[:-1], edges[1:])]
+
+
+# ----------------------------------------------------------------------------
+#   Combining the results
+# ----------------------------------------------------------------------------
+def _concat(results, labels, group_keys, pos, index):
+    """ Concatenates the per-group frames (or series). With `group_keys`,
+        the group labels are added to the index. Without them, results
+        indexed like their group (e.g. `pd.isna`) are put back in the order
+        of the original rows, like `GroupBy.apply` on a unique index
+    """
+    if group_keys:
+        return pd.concat(results, keys=labels, names=labels.names)
+    res = pd.concat(results)
+    if res.index.equals(index):
+        res = res.iloc[np.argsort(pos, kind='stable')]
+    return res
+
+
+def _combine(results, labels, group_keys=True, pos=None, index=None):
+    """ Combines the per-group results the same way `GroupBy.apply` does.
+        `pos` and `index` are the row positions and the index of the frame
+        sorted by group (see `_concat`)
+    """
+    if len(results) == 0:
+        return pd.Series([], index=labels, dtype=object)
+    if all(isinstance(res, pd.DataFrame) for res in results):
+        return _concat(results, labels, group_keys, pos, index)
+    if all(isinstance(res, pd.Series) for res in results):
+        first = results[0].index
+        if all(res.index.equals(first) for res in results):
+            columns = first.copy()
+            if columns.name is None:
+                names = {res.name for res in results}
+                if len(names) == 1:
+                    columns.name = names.pop()
+            return pd.DataFrame(np.vstack([res.to_numpy() for res in results]),
+                                index=labels, columns=columns) \
+                .infer_objects()
+        return _concat(results, labels, group_keys, pos, index)
+    return pd.Series(results, index=labels)
+
+
+# ----------------------------------------------------------------------------
+#   parallel_apply
+# ----------------------------------------------------------------------------
+def _group_positions(groups):
+    """ Same as `grp_tools.group_positions` for the GroupBy object `groups`.
+        The group numbers come from `groups.ngroup()`, so any grouper and
+        the `sort` and `dropna` options are honoured
+    """
+    codes = groups.ngroup().fillna(-1).to_numpy(dtype=np.int64)
+    labels = groups.size().index
+    pos = np.argsort(codes, kind='stable')
+    pos = pos[codes[pos] >= 0]
+    sorted_codes = codes[pos]
+    starts = np.flatnonzero(np.r_[True, sorted_codes[1:] != sorted_codes[:-1]])
+    ends = np.r_[starts[1:], len(pos)]
+    if len(pos) == 0:
+        starts = ends = np.empty(0, dtype=np.int64)
+    return pos, labels[sorted_codes[starts]], starts, ends
+
+
+def parallel_apply(groups, func, workers=None, include_groups=False,
+                   shards_per_worker=4):
+    """ Same as `groups.apply(func)` with the groups spread over a pool of
+        `workers` processes (default: number of CPUs).
+
+        Groups are split into shards of consecutive groups with a balanced
+        number of rows, and the results are returned in group order. As in
+        recent pandas versions, the grouping columns are not passed to
+        `func` unless `include_groups` is True. `func` must be picklable.
+        Results are combined as in `GroupBy.apply`, honouring the
+        `group_keys`, `sort` and `dropna` options of `groups`. Series
+        groupbys and `as_index=False` go to `groups.apply`.
+    """
+    if isinstance(groups.obj, pd.Series) or not groups.as_index:
+        return groups.apply(func)
+    pos, labels, starts, ends = _group_positions(groups)
+    # The frame `GroupBy.apply` passes to `func`: the selected columns,
+    # without the grouping columns unless `include_groups` is True
+    df = groups._selected_obj if include_groups \
+        else groups._obj_with_exclusions
+    sorted_df = df.iloc[pos]
+
+    def combine(results):
+        return _combine(results, labels, groups.group_keys, pos,
+                        sorted_df.index)
+
+    workers = workers or os.cpu_count() or 1
+    if workers == 1 or len(starts) <= 1:
+        results = [func(sorted_df.iloc[start:end])
+                   for start, end in zip(starts.tolist(), ends.tolist())]
+        return combine(results)
+
+    blocks = []
+    try:
+        col_specs = [(col, _share_values(sorted_df[col], blocks))
+                     for col in sorted_df.columns]
+        index_spec = _share_values(sorted_df.index, blocks)
+        shards = _shards(starts, ends, workers * shards_per_worker)
+        results = []
+        with ProcessPoolExecutor(
+                max_workers=workers,
+                initializer=_init_worker,
+                initargs=(col_specs, index_spec,
+                          list(sorted_df.index.names), func)) as pool:
+            # `map` returns the shards in order
+            for shard_res in pool.map(_run_shard, shards):
+                results.extend(shard_res)
+    finally:
+        for shm in blocks:
+            shm.close()
+            shm.unlink()
+    return combine(results)
+
+
+# ----------------------------------------------------------------------------
+#   Benchmarks
+# ----------------------------------------------------------------------------
+def _get_last(df):
+    """ Sorts the dataframe on its index and returns its last row. Defined
+        at module level so the workers can unpickle it
+    """
+    return df.sort_index().iloc[-1]
+
+
+def _check(groups, func, workers):
+    """ Checks `parallel_apply` against `groups.apply` and returns the
+        (pandas, parallel_apply) times
+    """
+    t0 = time.perf_counter()
+    expected = groups.apply(func)
+    t_pandas = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    res = parallel_apply(groups, func, workers=workers)
+    t_par = time.perf_counter() - t0
+
+    if isinstance(expected, pd.DataFrame):
+        pd.testing.assert_frame_equal(res, expected)
+    else:
+        pd.testing.assert_series_equal(res, expected)
+    return t_pandas, t_par
+
+
+def bench_parallel_apply(nobs=200_000, nfirms=2_000, workers=4):
+    """ Compares `groups.apply(func)` with `parallel_apply` for single and
+        multi-key groups, with and without `group_keys`, for unsorted
+        groups, a NaN group, a series grouper and an index level
+    """
+    from events import make_events
+
+    # `GroupBy.apply` only restores the row order on a unique index
+    df = make_events(nobs, nfirms=nfirms).reset_index()
+    df.loc[::97, 'firm'] = np.nan
+    by_level = df.set_index('firm', append=True)
+    print(f'--- {nobs:,} rows, {nfirms:,} firms, {workers} workers')
+    cases = [
+        ("'firm'", df.groupby('firm'), _get_last),
+        ("'firm'", df.groupby('firm'), len),
+        ("'firm'", df.groupby('firm'), pd.isna),
+        ("'firm', group_keys=False", df.groupby('firm', group_keys=False),
+         pd.isna),
+        ("['firm', 'action']", df.groupby(['firm', 'action']), _get_last),
+        ("['firm', 'action']", df.groupby(['firm', 'action']), len),
+        ("['firm', 'action'], group_keys=False",
+         df.groupby(['firm', 'action'], group_keys=False), pd.isna),
+        ("'firm', sort=False", df.groupby('firm', sort=False), _get_last),
+        ("'firm', dropna=False", df.groupby('firm', dropna=False), len),
+        ("df['firm']", df.groupby(df['firm']), _get_last),
+        ("level='firm'", by_level.groupby(level='firm'), len),
+        ]
+    for label, groups, func in cases:
+        t_pandas, t_par = _check(groups, func, workers)
+        print(f'{func.__name__:<9} by {label}: '
+              f'pandas {t_pandas:.3f}s, parallel_apply {t_par:.3f}s')
+
+
+if __name__ == "__main__":
+    bench_parallel_apply()
@@ -0,0 +1,248 @@
+""" grp_stats.py
+
+Vectorized kernels for common group reducers
+
+`fast_apply(groups, func)` recognizes reducers such as `len`, 'count',
+'first', 'last' and 'nunique' and computes them for all groups at once from
+the factorized group keys. Other functions are passed to `groups.apply`.
+
+`flat_agg(df, keys, how)` does the same for `df.groupby(keys).<how>()
+.reset_index()`, grouping on a single composite int64 key and returning the
+keys as flat columns, without building a MultiIndex.
+"""
+import time
+
+import numpy as np
+import pandas as pd
+
+from grp_tools import _as_keys, flat_groups
+
+
+# ----------------------------------------------------------------------------
+#   Kernels
+# ----------------------------------------------------------------------------
+def _size(codes, ngroups, data):
+    """ Number of rows in each group
+    """
+    return np.bincount(codes, minlength=ngroups)
+
+
+def _count(codes, ngroups, data):
+    """ Number of non-missing values in each group, for each column
+    """
+    return {col: np.bincount(codes, weights=data[col].notna().to_numpy(),
+                             minlength=ngroups).astype(np.int64)
+            for col in data.columns}
+
+
+def _nth_valid(codes, ngroups, ser, last):
+    """ Returns the first (or last) non-missing value of `ser` in each group
+    """
+    rows = np.flatnonzero(ser.notna().to_numpy())
+    if last:
+        pos = np.full(ngroups, -1, dtype=np.int64)
+        np.maximum.at(pos, codes[rows], rows)
+    else:
+        pos = np.full(ngroups, len(codes), dtype=np.int64)
+        np.minimum.at(pos, codes[rows], rows)
+        pos[pos == len(codes)] = -1
+    return pd.api.extensions.take(ser.array, pos, allow_fill=True)
+
+
+def _first(codes, ngroups, data):
+    """ First non-missing value in each group, for each column
+    """
+    return {col: _nth_valid(codes, ngroups, data[col], last=False)
+            for col in data.columns}
+
+
+def _last(codes, ngroups, data):
+    """ Last non-missing value in each group, for each column
+    """
+    return {col: _nth_valid(codes, ngroups, data[col], last=True)
+            for col in data.columns}
+
+
+def _nunique(codes, ngroups, data):
+    """ Number of distinct non-missing values in each group, for each column
+    """
+    res = {}
+    for col in data.columns:
+        ser = data[col]
+        if isinstance(ser.dtype, pd.CategoricalDtype):
+            vcodes = ser.cat.codes.to_numpy()
+            nvals = max(1, len(ser.cat.categories))
+        else:
+            vcodes, uniques = pd.factorize(ser)
+            nvals = max(1, len(uniques))
+        ok = vcodes >= 0
+        pairs = np.sort(codes[ok] * nvals + vcodes[ok])
+        if len(pairs):
+            pairs = pairs[np.r_[True, pairs[1:] != pairs[:-1]]]
+        res[col] = np.bincount(pairs // nvals, minlength=ngroups)
+    return res
+
+
+# Reducer passed to `fast_apply` --> kernel
+KERNELS = {
+    len: _size,
+    'size': _size,
+    'count': _count,
+    'first': _first,
+    'last': _last,
+    'nunique': _nunique,
+    pd.DataFrame.count: _count,
+    pd.DataFrame.nunique: _nunique,
+    }
+
+
+def _kernel(func):
+    """ Returns the kernel for `func`, or None if there is none
+    """
+    try:
+        return KERNELS.get(func)
+    except TypeError:
+        # unhashable callables
+        return None
+
+
+# ----------------------------------------------------------------------------
+#   fast_apply
+# ----------------------------------------------------------------------------
+def fast_apply(groups, func):
+    """ Same as `groups.apply(func)` for the reducers in KERNELS (for the
+        string reducers, the same as `groups.<name>()`). Any other `func`,
+        series groupbys and `as_index=False` are passed to `groups.apply`
+    """
+    kernel = _kernel(func)
+    if kernel is None or isinstance(groups.obj, pd.Series) \
+            or not groups.as_index:
+        return groups.apply(func)
+
+    # Reuse the group codes cached by the GroupBy object
+    codes = groups.ngroup().fillna(-1).to_numpy(dtype=np.int64)
+    labels = groups.size().index
+    # The frame the reducers see: the selected columns, without the
+    # grouping columns
+    data = groups._obj_with_exclusions
+    ok = codes >= 0
+    if not ok.all():
+        codes = codes[ok]
+        data = data.loc[ok]
+
+    res = kernel(codes, len(labels), data)
+    if isinstance(res, dict):
+        return pd.DataFrame(res, index=labels, columns=data.columns)
+    return pd.Series(res, index=labels)
+
+
+# ----------------------------------------------------------------------------
+#   flat_agg
+# ----------------------------------------------------------------------------
+def flat_agg(df, keys, how='last', cols=None):
+    """ Same as `df.groupby(keys).<how>().reset_index()`, where `how` is a
+        GroupBy method name such as 'last', 'sum' or 'size'. `cols` are the
+        columns to aggregate (default: all but the keys).
+
+        Groups are numbered with `grp_tools.flat_groups`. Reducers in
+        KERNELS run on these numbers directly, others go through a groupby
+        on a categorical built from them, which reuses the codes as they
+        are.
+    """
+    keys = _as_keys(keys)
+    codes, key_frame = flat_groups(df, keys)
+    if cols is None:
+        cols = [col for col in df.columns if col not in keys]
+    data = df.loc[:, cols]
+    ngroups = len(key_frame)
+
+    kernel = _kernel(how)
+    if kernel is not None:
+        ok = codes >= 0
+        if not ok.all():
+            codes, data = codes[ok], data.loc[ok]
+        res = kernel(codes, ngroups, data)
+        # Like `groupby(keys).size().reset_index()`, sizes go in column 0
+        res = pd.DataFrame(res, columns=data.columns) if isinstance(res, dict) \
+            else pd.DataFrame({0: res})
+    else:
+        groups = pd.Categorical.from_codes(
+            codes, categories=pd.RangeIndex(ngroups))
+        res = getattr(data.groupby(groups, observed=True), how)()
+        if isinstance(res, pd.Series):
+            res = res.to_frame()
+        res.index = key_frame.index
+    return pd.concat([key_frame, res], axis=1)
+
+
+# ----------------------------------------------------------------------------
+#   Benchmarks
+# ----------------------------------------------------------------------------
+def bench_fast_apply(sizes=(1_000_000, 10_000_000), nfirms=10_000):
+    """ Compares the three ways of computing group sizes in pd_groupby.py
+        (a loop over `groups.groups`, `groups.apply(len)` and
+        `groupby.size()`) with `fast_apply`, plus the other reducers
+    """
+    from events import make_events
+
+    for nobs in sizes:
+        df = make_events(nobs, nfirms=nfirms).reset_index()
+        groups = df.groupby('firm')
+        print(f'--- {nobs:,} rows, {nfirms:,} firms')
+
+        t0 = time.perf_counter()
+        {firm: len(df.loc[idx]) for firm, idx in groups.groups.items()}
+        print(f'loop with len(df.loc[idx]): {time.perf_counter() - t0:.3f}s')
+
+        cases = [
+            ('apply(len)', lambda: groups.apply(len), len),
+            ('size()', groups.size, len),
+            ('count()', groups.count, 'count'),
+            ('first()', groups.first, 'first'),
+            ('last()', groups.last, 'last'),
+            ('nunique()', groups.nunique, 'nunique'),
+            ]
+        for label, slow, func in cases:
+            t0 = time.perf_counter()
+            expected = slow()
+            t_slow = time.perf_counter() - t0
+
+            t0 = time.perf_counter()
+            res = fast_apply(groups, func)
+            t_fast = time.perf_counter() - t0
+
+            assert np.array_equal(res.to_numpy(), expected.to_numpy())
+            print(f'{label:<12} pandas {t_slow:.3f}s, fast_apply {t_fast:.3f}s')
+
+
+def bench_flat_agg(nobs=2_000_000, nfirms=5_000):
+    """ Compares a 5-key rollup `groupby(keys).last().reset_index()` with
+        `flat_agg`
+    """
+    from events import make_events
+
+    df = make_events(nobs, nfirms=nfirms).reset_index()
+    df['event_date'] = df['date'].dt.normalize()
+    df['year'] = df['date'].dt.year
+    df['weekday'] = df['date'].dt.weekday
+    keys = ['event_date', 'firm', 'action', 'year', 'weekday']
+    print(f'--- {nobs:,} rows, keys: {keys}')
+
+    for how in ('last', 'size', 'max'):
+        t0 = time.perf_counter()
+        expected = getattr(df.groupby(keys), how)().reset_index()
+        t_pandas = time.perf_counter() - t0
+
+        t0 = time.perf_counter()
+        res = flat_agg(df, keys, how)
+        t_flat = time.perf_counter() - t0
+
+        assert res.columns.equals(expected.columns)
+        assert np.array_equal(res.to_numpy(), expected.to_numpy())
+        print(f'{how:<5} groupby + reset_index {t_pandas:.3f}s, '
+              f'flat_agg {t_flat:.3f}s')
+
+
+if __name__ == "__main__":
+    bench_fast_apply()
+    bench_flat_agg()
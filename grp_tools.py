@@ -0,0 +1,366 @@
+""" grp_tools.py
+
+Vectorized helpers for GroupBy-style operations on large event frames
+"""
+import time
+
+import numpy as np
+import pandas as pd
+
+
+# ----------------------------------------------------------------------------
+#   Group codes
+# ----------------------------------------------------------------------------
+def _as_keys(keys):
+    """ Returns `keys` as a list of column labels
+    """
+    if isinstance(keys, (list, tuple)):
+        return list(keys)
+    return [keys]
+
+
+def group_codes(df, keys):
+    """ Returns a tuple with (codes, uniques) where `codes` is an int64 array
+        with the (sorted) group number of each row in `df` and `uniques` is
+        an index with the group labels. Rows with missing keys get code -1,
+        like `groupby` drops them.
+    """
+    keys = _as_keys(keys)
+    if len(keys) == 1:
+        codes, uniques = pd.factorize(df[keys[0]], sort=True)
+        return codes.astype(np.int64), pd.Index(uniques, name=keys[0])
+    codes, key_codes, levels = _flat_groups(df, keys)
+    uniques = pd.MultiIndex(levels=levels, codes=key_codes, names=keys,
+                            verify_integrity=False)
+    return codes, uniques
+
+
+# ----------------------------------------------------------------------------
+#   Composite keys
+# ----------------------------------------------------------------------------
+# Largest number of distinct values a composite key may hold before it is
+# compressed (see `composite_key`)
+_MAX_KEY = 2**62
+
+
+def composite_key(df, keys):
+    """ Packs the columns `keys` of `df` into a single int64 key using
+        mixed-radix encoding of their sorted factorized codes, so sorting
+        by the key sorts by the columns. Returns (key, codes, levels),
+        where `codes[i]` and `levels[i]` are the codes and sorted unique
+        values of keys[i]. Rows with a missing key get -1.
+
+        If the product of the numbers of values would overflow, the
+        partial key is compressed to dense codes first.
+    """
+    keys = _as_keys(keys)
+    key = np.zeros(len(df), dtype=np.int64)
+    missing = np.zeros(len(df), dtype=bool)
+    size = 1
+    codes, levels = [], []
+    for col in keys:
+        col_codes, uniques = pd.factorize(df[col], sort=True)
+        col_codes = col_codes.astype(np.int64)
+        radix = max(1, len(uniques))
+        if size * radix > _MAX_KEY:
+            key, dense = pd.factorize(key, sort=True)
+            key = key.astype(np.int64)
+            size = len(dense)
+        key = key * radix + np.maximum(col_codes, 0)
+        size *= radix
+        missing |= col_codes < 0
+        codes.append(col_codes)
+        levels.append(pd.Index(uniques, name=col))
+    key[missing] = -1
+    return key, codes, levels
+
+
+def _flat_groups(df, keys):
+    """ Returns (codes, key_codes, levels): the sorted group number of each
+        row (-1 if a key is missing), and for each key the codes into
+        levels[i] of the value of that key in each group
+    """
+    key, codes, levels = composite_key(df, keys)
+    ok = key >= 0
+    rows = np.arange(len(key)) if ok.all() else np.flatnonzero(ok)
+    key = key[rows]
+    group_codes = np.full(len(ok), -1, dtype=np.int64)
+    if len(rows) and key.max() < 4 * len(rows):
+        # Few possible keys: rank them with a table of the keys present
+        present = np.zeros(key.max() + 1, dtype=bool)
+        present[key] = True
+        rank = np.cumsum(present) - 1
+        group_codes[rows] = rank[key]
+        # One row of each group, to read its key values
+        first = np.empty(int(present.sum()), dtype=np.int64)
+        first[rank[key]] = rows
+    else:
+        # The order of rows with equal keys does not matter here, so the
+        # faster unstable sort is fine
+        order = np.argsort(key)
+        sorted_key = key[order]
+        is_new = np.empty(len(key), dtype=bool)
+        is_new[:1] = True
+        np.not_equal(sorted_key[1:], sorted_key[:-1], out=is_new[1:])
+        group_codes[rows[order]] = np.cumsum(is_new) - 1
+        first = rows[order[is_new]]
+    return group_codes, [col_codes[first] for col_codes in codes], levels
+
+
+def flat_groups(df, keys):
+    """ Returns (codes, key_frame), where `codes` holds the sorted group
+        number of each row of `df` (-1 if a key is missing) and `key_frame`
+        has one row per group with the key values as flat columns
+    """
+    codes, key_codes, levels = _flat_groups(df, keys)
+    key_frame = pd.DataFrame(
+        {level.name: level.take(col_codes) for level, col_codes
+         in zip(levels, key_codes)})
+    return codes, key_frame
+
+
+# ----------------------------------------------------------------------------
+#   Last observation by group
+# ----------------------------------------------------------------------------
+def last_by_group(df, keys, order_by=None):
+    """ Returns the last row of each group in `df`, after sorting the rows in
+        each group by `order_by` (the index if None).
+
+        Same result as `df.groupby(keys).apply(get_last)`, but the frame is
+        sorted once and the tail of each group is selected in one pass.
+    """
+    codes, uniques = group_codes(df, keys)
+    if order_by is None:
+        order = df.index.to_numpy()
+    else:
+        order = df[order_by].to_numpy()
+
+    # `lexsort` is stable and sorts by the last key first
+    pos = np.lexsort((order, codes))
+    pos = pos[codes[pos] >= 0]
+    sorted_codes = codes[pos]
+
+    # The last row of a group is the one followed by a different code
+    is_last = np.ones(len(pos), dtype=bool)
+    is_last[:-1] = sorted_codes[1:] != sorted_codes[:-1]
+
+    res = df.iloc[pos[is_last]].copy()
+    res.index = uniques[sorted_codes[is_last]]
+    return res
+
+
+# ----------------------------------------------------------------------------
+#   Group offsets and iteration
+# ----------------------------------------------------------------------------
+def group_positions(df, keys):
+    """ Returns a tuple (pos, labels, starts, ends), where `pos` holds the
+        row positions of `df` sorted by group and the rows of the group
+        labels[g] are at pos[starts[g]:ends[g]]. Rows with missing keys are
+        left out.
+    """
+    codes, uniques = group_codes(df, keys)
+    pos = np.argsort(codes, kind='stable')
+    pos = pos[codes[pos] >= 0]
+    sorted_codes = codes[pos]
+
+    # Groups start where the code changes
+    starts = np.flatnonzero(np.r_[True, sorted_codes[1:] != sorted_codes[:-1]])
+    ends = np.r_[starts[1:], len(pos)]
+    if len(pos) == 0:
+        starts = ends = np.empty(0, dtype=np.int64)
+    labels = uniques[sorted_codes[starts]]
+    return pos, labels, starts, ends
+
+
+def group_offsets(df, keys):
+    """ Sorts `df` once by group and returns a tuple with
+        (sorted_df, labels, starts, ends), where the rows of the group
+        labels[g] are sorted_df.iloc[starts[g]:ends[g]].
+
+        Rows keep their original order inside each group, as in `groupby`.
+    """
+    pos, labels, starts, ends = group_positions(df, keys)
+    return df.iloc[pos], labels, starts, ends
+
+
+def iter_groups(df, keys):
+    """ Yields (label, group) for each group in `df`, where `group` is a
+        contiguous slice of the frame sorted once by group. No label lookup
+        or copy is done per group, and the index of `df` is kept.
+    """
+    sorted_df, labels, starts, ends = group_offsets(df, keys)
+    for label, start, end in zip(labels, starts, ends):
+        yield label, sorted_df.iloc[start:end]
+
+
+def iter_group_arrays(df, keys, cols=None):
+    """ Same as `iter_groups`, but each group is a dictionary with
+        column --> NumPy view, plus the index under the key None. This
+        avoids building one dataframe per group, which dominates when there
+        are millions of small groups.
+    """
+    sorted_df, labels, starts, ends = group_offsets(df, keys)
+    cols = list(sorted_df.columns) if cols is None else list(cols)
+    arrays = {col: sorted_df[col].to_numpy() for col in cols}
+    arrays[None] = sorted_df.index.to_numpy()
+    for label, start, end in zip(labels, starts.tolist(), ends.tolist()):
+        yield label, {col: arr[start:end] for col, arr in arrays.items()}
+
+
+# ----------------------------------------------------------------------------
+#   Row replication
+# ----------------------------------------------------------------------------
+def _repeat_values(ser, counts):
+    """ Returns the values of `ser` with each one repeated `counts` times
+    """
+    if isinstance(ser.dtype, np.dtype):
+        return np.repeat(ser.to_numpy(), counts)
+    # Extension arrays (categorical, str, nullable, tz-aware, ...)
+    return ser.array.repeat(counts)
+
+
+def repeat_rows(df, counts):
+    """ Returns a frame where the i-th row of `df` appears `counts[i]` times
+        in a row (or `counts` times if it is an integer), with the same
+        columns, dtypes and repeated index labels.
+
+        Each column is repeated with a single `np.repeat` (or the
+        `repeat` method of extension arrays), without concat or transpose.
+    """
+    counts = np.asarray(counts)
+    if counts.size == 0:
+        # np.asarray([]) is float64
+        counts = counts.astype(np.int64)
+    # Bools and floats are rejected rather than truncated
+    if counts.dtype.kind not in 'iu':
+        raise ValueError('counts must be integers')
+    if counts.ndim == 0:
+        counts = int(counts)
+        if counts < 0:
+            raise ValueError('counts must be non-negative')
+    else:
+        if len(counts) != len(df):
+            raise ValueError('counts must be integers, one per row')
+        if (counts < 0).any():
+            raise ValueError('counts must be non-negative')
+    index = df.index.repeat(counts)
+    if isinstance(df, pd.Series):
+        return pd.Series(_repeat_values(df, counts), index=index,
+                         name=df.name, copy=False)
+    # Columns by position, so duplicate labels are fine
+    data = {pos: _repeat_values(df.iloc[:, pos], counts)
+            for pos in range(df.shape[1])}
+    res = pd.DataFrame(data, index=index, copy=False)
+    res.columns = df.columns
+    return res
+
+
+# ----------------------------------------------------------------------------
+#   Benchmarks
+# ----------------------------------------------------------------------------
+def _get_last(df):
+    """ Sorts the dataframe on its index and returns
+        last row of the sorted dataframe
+    """
+    df.sort_index(inplace=True)
+    return df.iloc[-1]
+
+
+def bench_last_by_group(nobs=1_000_000, nfirms=10_000):
+    """ Compares `groups.apply(get_last)` with `last_by_group`
+    """
+    from events import make_events
+
+    df = make_events(nobs, nfirms)
+
+    t0 = time.perf_counter()
+    expected = df.groupby('firm').apply(_get_last)
+    t_apply = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    res = last_by_group(df, 'firm')
+    t_fast = time.perf_counter() - t0
+
+    pd.testing.assert_frame_equal(res.loc[:, expected.columns], expected)
+    print(f'groups.apply(get_last): {t_apply:.3f}s')
+    print(f'last_by_group:          {t_fast:.3f}s')
+
+
+def bench_iter_groups(nobs=1_000_000, nfirms=10_000):
+    """ Compares `df.loc[idx]` for each item in `groups.groups` with
+        `iter_groups`, applying `len` to each group
+    """
+    from events import make_events
+
+    df = make_events(nobs, nfirms)
+    # `df.loc[idx]` needs unique labels to select only the rows of the group
+    df = df.loc[~df.index.duplicated()].sort_index()
+
+    t0 = time.perf_counter()
+    groups = df.groupby('firm')
+    expected = {firm: len(df.loc[idx]) for firm, idx in groups.groups.items()}
+    t_loc = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    res = {firm: len(grp) for firm, grp in iter_groups(df, 'firm')}
+    t_iter = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    res_arr = {firm: len(grp[None])
+               for firm, grp in iter_group_arrays(df, 'firm')}
+    t_arr = time.perf_counter() - t0
+
+    assert res == expected and res_arr == expected
+    print(f'df.loc[idx] per group: {t_loc:.3f}s')
+    print(f'iter_groups:           {t_iter:.3f}s')
+    print(f'iter_group_arrays:     {t_arr:.3f}s')
+
+
+def five_copies2(ser):
+    """ concatenate `ser` five times (as in pd_groupby.py)
+    """
+    ser_lst = [ser] * 5
+    wrong_df = pd.concat(ser_lst, axis=1)
+    right_df = wrong_df.transpose()
+    return right_df
+
+
+def bench_repeat_rows(nobs=1_000_000, copies=100, nslow=1_000):
+    """ Compares `five_copies2` applied to each row, `df.iloc` with
+        repeated positions and `repeat_rows` for `copies` copies of each of
+        `nobs` rows (`five_copies2` only runs on the first `nslow` rows)
+    """
+    from events import make_events
+
+    df = make_events(nobs, nfirms=1_000)
+    df['firm'] = df['firm'].astype('category')
+    df['price'] = np.arange(nobs, dtype=np.float64)
+    print(f'--- {nobs:,} rows x {copies} copies')
+
+    t0 = time.perf_counter()
+    small = df.iloc[:nslow]
+    pd.concat([five_copies2(row) for _, row in small.iterrows()])
+    t_five = (time.perf_counter() - t0) / nslow * nobs * copies / 5
+    print(f'five_copies2 per row (extrapolated): {t_five:.1f}s')
+
+    t0 = time.perf_counter()
+    expected = df.iloc[np.repeat(np.arange(nobs), copies)]
+    print(f'df.iloc[np.repeat(...)]: {time.perf_counter() - t0:.3f}s')
+
+    t0 = time.perf_counter()
+    res = repeat_rows(df, copies)
+    print(f'repeat_rows:             {time.perf_counter() - t0:.3f}s')
+    pd.testing.assert_frame_equal(res, expected)
+    del expected, res
+
+    counts = np.random.default_rng(0).integers(0, 2 * copies, nobs)
+    t0 = time.perf_counter()
+    res = repeat_rows(df, counts)
+    print(f'repeat_rows, varying counts ({len(res):,} rows): '
+          f'{time.perf_counter() - t0:.3f}s')
+
+
+if __name__ == "__main__":
+    bench_last_by_group()
+    bench_iter_groups()
+    bench_repeat_rows()
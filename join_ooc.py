@@ -0,0 +1,186 @@
+""" join_ooc.py
+
+Out-of-core join for tables larger than memory
+
+Both inputs are read chunk by chunk and their rows are split into
+partitions on disk (under `cfg.DATADIR`) by hash or by ranges of the index.
+Rows with the same index label always land in the same partition, so each
+pair of partitions can be joined on its own with `merge_join` and the
+results are streamed out, one dataframe at a time.
+"""
+import os
+import shutil
+import tempfile
+import warnings
+
+import numpy as np
+import pandas as pd
+
+import toolkit_config as cfg
+from join_tools import merge_join
+
+# Default memory budget for one pair of partitions
+MAX_BYTES = 512 * 2**20
+
+# Maximum number of times a partition pair is split again
+MAX_DEPTH = 4
+
+# Odd 64-bit constant mixed into the hashes to get a new split at each depth
+_SALT = 0x9E3779B97F4A7C15
+
+
+# ----------------------------------------------------------------------------
+#   Partitions on disk
+# ----------------------------------------------------------------------------
+def _chunks(obj):
+    """ Returns `obj` as an iterable of dataframes
+    """
+    if isinstance(obj, (pd.DataFrame, pd.Series)):
+        return [obj.to_frame() if isinstance(obj, pd.Series) else obj]
+    return obj
+
+
+def _part_ids(index, nparts, bounds=None, salt=0):
+    """ Returns the partition number of each label in `index`. With a
+        non-zero `salt`, the hashes are mixed again so labels which shared a
+        partition are spread over new ones. (The `hash_key` option of
+        `hash_pandas_object` would only change the hashes of strings.)
+    """
+    if bounds is not None:
+        return np.searchsorted(np.asarray(bounds, dtype=index.dtype),
+                               index.to_numpy(), side='right')
+    hashed = pd.util.hash_pandas_object(index, index=False).to_numpy()
+    if salt:
+        hashed = pd.util.hash_array(
+            hashed ^ np.uint64(_SALT * salt % 2**64))
+    return (hashed % np.uint64(nparts)).astype(np.int64)
+
+
+class _Spill:
+    """ Writes the chunks of one side of the join to partition folders and
+        keeps track of the number of bytes in each partition
+    """
+
+    def __init__(self, folder, side):
+        self.folder = folder
+        self.side = side
+        self.schema = None
+        self.nbytes = {}
+        self.nfiles = {}
+
+    def write(self, chunk, part_ids):
+        if self.schema is None:
+            self.schema = chunk.iloc[:0]
+        order = np.argsort(part_ids, kind='stable')
+        part_ids = part_ids[order]
+        starts = np.flatnonzero(np.r_[True, part_ids[1:] != part_ids[:-1]])
+        ends = np.r_[starts[1:], len(order)]
+        for start, end in zip(starts, ends):
+            part = int(part_ids[start])
+            piece = chunk.iloc[order[start:end]]
+            nfile = self.nfiles.get(part, 0)
+            folder = os.path.join(self.folder, f'part{part}')
+            os.makedirs(folder, exist_ok=True)
+            piece.to_pickle(os.path.join(folder, f'{self.side}{nfile}.pkl'))
+            self.nfiles[part] = nfile + 1
+            self.nbytes[part] = self.nbytes.get(part, 0) \
+                + int(piece.memory_usage(deep=True).sum())
+
+    def pieces(self, part):
+        """ Yields the chunks stored in partition `part`
+        """
+        folder = os.path.join(self.folder, f'part{part}')
+        for nfile in range(self.nfiles.get(part, 0)):
+            loc = os.path.join(folder, f'{self.side}{nfile}.pkl')
+            yield pd.read_pickle(loc)
+
+    def read(self, part):
+        """ Returns all the rows in partition `part`
+        """
+        pieces = list(self.pieces(part))
+        if not pieces:
+            return self.schema if self.schema is not None else pd.DataFrame()
+        return pd.concat(pieces)
+
+
+def _partition(left, right, folder, nparts, bounds, salt):
+    """ Splits both inputs into partitions stored in `folder`
+    """
+    lspill = _Spill(folder, 'left')
+    rspill = _Spill(folder, 'right')
+    for spill, chunks in ((lspill, left), (rspill, right)):
+        for chunk in _chunks(chunks):
+            if len(chunk):
+                spill.write(chunk, _part_ids(chunk.index, nparts, bounds, salt))
+            elif spill.schema is None:
+                spill.schema = chunk.iloc[:0]
+    return lspill, rspill
+
+
+# ----------------------------------------------------------------------------
+#   The join
+# ----------------------------------------------------------------------------
+def _join_parts(lspill, rspill, folder, how, lsuffix, rsuffix, nparts,
+                max_bytes, depth):
+    """ Joins each pair of partitions, splitting pairs over the memory
+        budget again with another hash
+    """
+    parts = sorted(set(lspill.nfiles) | set(rspill.nfiles))
+    for part in parts:
+        nbytes = lspill.nbytes.get(part, 0) + rspill.nbytes.get(part, 0)
+        if nbytes > max_bytes and depth == MAX_DEPTH:
+            # Usually a few labels with many rows, which no hash can split
+            warnings.warn(
+                f'Partition pair still has {nbytes:,} bytes after '
+                f'{MAX_DEPTH} splits (max_bytes={max_bytes:,}), joining it '
+                f'in memory', RuntimeWarning, stacklevel=2)
+        elif nbytes > max_bytes:
+            sub = os.path.join(folder, f'part{part}', 'split')
+            sub_left, sub_right = _partition(
+                lspill.pieces(part), rspill.pieces(part), sub,
+                nparts, None, salt=depth + 1)
+            sub_left.schema = lspill.schema
+            sub_right.schema = rspill.schema
+            yield from _join_parts(sub_left, sub_right, sub, how, lsuffix,
+                                   rsuffix, nparts, max_bytes, depth + 1)
+            shutil.rmtree(sub, ignore_errors=True)
+            continue
+
+        lpart = lspill.read(part).sort_index(kind='stable')
+        rpart = rspill.read(part).sort_index(kind='stable')
+        res = merge_join(lpart, rpart, how=how, lsuffix=lsuffix,
+                         rsuffix=rsuffix)
+        if len(res):
+            yield res
+
+
+def ooc_join(left, right, how='left', lsuffix='', rsuffix='', nparts=64,
+             max_bytes=MAX_BYTES, bounds=None, tmpdir=None):
+    """ Generator with the result of `left.join(right, how=how)`, where
+        `left` and `right` are dataframes or iterables of dataframes (e.g.
+        `prc_reader.iter_prices`) joined on their indexes.
+
+        Rows are hash-partitioned into `nparts` partitions, or
+        range-partitioned if `bounds` (sorted split labels) is given, in a
+        temporary folder under `tmpdir` (default: `cfg.DATADIR`). Pairs of
+        partitions larger than `max_bytes` are split again by hash, up to
+        MAX_DEPTH times. A pair still over budget after that (e.g. a label
+        with too many rows) is joined in memory with a RuntimeWarning.
+
+        Each yielded dataframe is the sorted join of one partition pair.
+        With range partitions that were not split again, the output is
+        sorted by index overall.
+    """
+    if how not in ('left', 'right', 'inner', 'outer'):
+        raise ValueError(f'Invalid join type: {how}')
+    if bounds is not None:
+        nparts = len(bounds) + 1
+    root = tmpdir or cfg.DATADIR
+    os.makedirs(root, exist_ok=True)
+    folder = tempfile.mkdtemp(prefix='.ooc_join_', dir=root)
+    try:
+        lspill, rspill = _partition(left, right, folder, nparts, bounds, 0)
+        yield from _join_parts(lspill, rspill, folder, how, lsuffix,
+                               rsuffix, nparts, max_bytes, depth=0)
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
@@ -0,0 +1,350 @@
+""" join_tools.py
+
+Join helpers for date-indexed price frames
+"""
+import time
+import tracemalloc
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+
+# ----------------------------------------------------------------------------
+#   Helpers
+# ----------------------------------------------------------------------------
+def _take(ser, idx):
+    """ Returns the values of `ser` at positions `idx` (all of them if None).
+        Positions equal to -1 produce missing values (ints are upcast to
+        float, as in `join`)
+    """
+    if idx is None:
+        return ser.array
+    if len(idx) == 0 or idx.min() >= 0:
+        return ser.array.take(idx)
+    values = ser.to_numpy() if isinstance(ser.dtype, np.dtype) else ser.array
+    return pd.api.extensions.take(values, idx, allow_fill=True)
+
+
+def _suffixed(left, right, lsuffix, rsuffix):
+    """ Returns the columns of `left` and `right` with suffixes added to
+        overlapping labels, like `DataFrame.join`
+    """
+    overlap = left.columns.intersection(right.columns)
+    if len(overlap) == 0:
+        return list(left.columns), list(right.columns)
+    if not lsuffix and not rsuffix:
+        raise ValueError(f'columns overlap but no suffix specified: {overlap}')
+    lcols = [f'{c}{lsuffix}' if c in overlap else c for c in left.columns]
+    rcols = [f'{c}{rsuffix}' if c in overlap else c for c in right.columns]
+    return lcols, rcols
+
+
+def _build(left, right, index, lidx, ridx, lsuffix, rsuffix):
+    """ Assembles the joined frame from the row positions `lidx` and `ridx`
+    """
+    lcols, rcols = _suffixed(left, right, lsuffix, rsuffix)
+    # Columns by position, so duplicate labels are fine
+    arrays = [_take(ser, lidx) for _, ser in left.items()] \
+        + [_take(ser, ridx) for _, ser in right.items()]
+    res = pd.DataFrame(dict(enumerate(arrays)), index=index, copy=False)
+    res.columns = lcols + rcols
+    return res
+
+
+# ----------------------------------------------------------------------------
+#   Sort-merge join
+# ----------------------------------------------------------------------------
+def merge_join(left, right, how='left', lsuffix='', rsuffix=''):
+    """ Same as `left.join(right, how=how)` for frames joined on their
+        indexes.
+
+        If both indexes are sorted, the row positions come from a linear
+        merge of the two indexes (`Index.join` on monotonic indexes), so no
+        hash table is built. Columns on a side whose rows are kept as they
+        are (e.g. the left side of a left join) are not copied. Otherwise
+        `DataFrame.join` is used.
+    """
+    if how not in ('left', 'right', 'inner', 'outer'):
+        raise ValueError(f'Invalid join type: {how}')
+    if isinstance(right, pd.Series):
+        if right.name is None:
+            raise ValueError('Other Series must have a name')
+        right = right.to_frame()
+    lindex = left.index
+    rindex = right.index
+    if not (lindex.is_monotonic_increasing
+            and rindex.is_monotonic_increasing):
+        return left.join(right, how=how, lsuffix=lsuffix, rsuffix=rsuffix)
+
+    index, lidx, ridx = lindex.join(rindex, how=how, return_indexers=True)
+    return _build(left, right, index, lidx, ridx, lsuffix, rsuffix)
+
+
+# ----------------------------------------------------------------------------
+#   Alignment cache
+# ----------------------------------------------------------------------------
+def _fingerprint(index):
+    """ Returns a hashable summary of the labels in `index`
+    """
+    hashed = pd.util.hash_pandas_object(index, index=False).to_numpy()
+    return (len(index), str(index.dtype), index.names[0],
+            hash(hashed.tobytes()))
+
+
+def _reindex_rows(obj, index, idx):
+    """ Returns `obj` (series or dataframe) with rows taken from positions
+        `idx` (all rows if None) and `index` as its row index
+    """
+    if isinstance(obj, pd.Series):
+        return pd.Series(_take(obj, idx), index=index, name=obj.name,
+                         copy=False)
+    data = {pos: _take(ser, idx) for pos, (_, ser) in enumerate(obj.items())}
+    res = pd.DataFrame(data, index=index, copy=False)
+    res.columns = obj.columns
+    return res
+
+
+class AlignCache:
+    """ LRU cache of alignment plans (joined index and row indexers) for
+        pairs of indexes, so arithmetic between objects sharing the same
+        two indexes only aligns them once.
+
+        Indexes are matched by identity (the cached entry keeps them alive,
+        so ids cannot be reused) or, if `fingerprint` is True, by a hash of
+        their labels.
+    """
+
+    def __init__(self, maxsize=128, fingerprint=False):
+        self.maxsize = maxsize
+        self.fingerprint = fingerprint
+        self.hits = 0
+        self.misses = 0
+        self._plans = OrderedDict()
+
+    def __len__(self):
+        return len(self._plans)
+
+    def stats(self):
+        """ Returns a dictionary with the hit/miss counters
+        """
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'size': len(self._plans),
+            'maxsize': self.maxsize,
+            'hit_rate': self.hits / total if total else 0.0,
+            }
+
+    def clear(self):
+        """ Removes all plans and resets the counters
+        """
+        self._plans.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def _key(self, lindex, rindex, how):
+        if self.fingerprint:
+            return _fingerprint(lindex), _fingerprint(rindex), how
+        return id(lindex), id(rindex), how
+
+    def plan(self, lindex, rindex, how='outer'):
+        """ Returns (index, lidx, ridx) as `lindex.join(rindex, how=how,
+            return_indexers=True)`, computed once per pair of indexes
+        """
+        key = self._key(lindex, rindex, how)
+        entry = self._plans.get(key)
+        if entry is not None:
+            self.hits += 1
+            self._plans.move_to_end(key)
+            return entry[2:]
+
+        self.misses += 1
+        if lindex.equals(rindex):
+            index, lidx, ridx = lindex, None, None
+        else:
+            index, lidx, ridx = lindex.join(rindex, how=how,
+                                            return_indexers=True)
+        self._plans[key] = (lindex, rindex, index, lidx, ridx)
+        if len(self._plans) > self.maxsize:
+            self._plans.popitem(last=False)
+        return index, lidx, ridx
+
+    def align(self, left, right, how='outer'):
+        """ Same as `left.align(right, join=how, axis=0)` using the cached
+            plan. Both results share the same index object
+        """
+        index, lidx, ridx = self.plan(left.index, right.index, how=how)
+        return (_reindex_rows(left, index, lidx),
+                _reindex_rows(right, index, ridx))
+
+    def binop(self, left, right, op, how='outer'):
+        """ Applies `op` (e.g. `operator.add`) to `left` and `right` after
+            aligning their rows with the cached plan. Same as
+            `op(left, right)` for pandas objects. A frame and a series are
+            aligned on the columns by pandas, so they skip the cache
+        """
+        if isinstance(left, pd.Series) != isinstance(right, pd.Series):
+            return op(left, right)
+        left, right = self.align(left, right, how=how)
+        return op(left, right)
+
+
+# ----------------------------------------------------------------------------
+#   As-of join
+# ----------------------------------------------------------------------------
+def _sorted(df):
+    """ Returns `df` sorted by its index, without copying if it already is
+    """
+    if df.index.is_monotonic_increasing:
+        return df
+    return df.sort_index(kind='stable')
+
+
+def asof_join(left, right, by=None, direction='backward', tolerance=None,
+              allow_exact_matches=True, right_key=None,
+              suffixes=('_x', '_y')):
+    """ Matches each row of `left` with the nearest row of `right` by index
+        (e.g. each analyst event with the most recent close). Both frames
+        are indexed by date.
+
+        Parameters
+        ----------
+        by : column label(s) which must also match (e.g. the ticker)
+        direction : 'backward' (last right row at or before), 'forward'
+            (first right row at or after) or 'nearest'
+        tolerance : maximum distance between the matched dates, as a
+            Timedelta or a string such as '3D'
+        right_key : if given, name of a new column with the matched index
+            label of `right`
+
+        Frames are sorted by index only if needed, and the match is a single
+        linear merge of the two sorted frames (`pd.merge_asof`). The result
+        has the rows of `left` sorted by index.
+    """
+    if isinstance(tolerance, str):
+        tolerance = pd.Timedelta(tolerance)
+    lsorted = _sorted(left)
+    rsorted = _sorted(right)
+    # Both indexes must have the same datetime resolution
+    if isinstance(lsorted.index, pd.DatetimeIndex) \
+            and isinstance(rsorted.index, pd.DatetimeIndex) \
+            and lsorted.index.unit != rsorted.index.unit:
+        rsorted = rsorted.set_axis(rsorted.index.as_unit(lsorted.index.unit))
+    if right_key is not None:
+        rsorted = rsorted.assign(**{right_key: rsorted.index})
+    return pd.merge_asof(
+        lsorted, rsorted,
+        left_index=True,
+        right_index=True,
+        by=by,
+        direction=direction,
+        tolerance=tolerance,
+        allow_exact_matches=allow_exact_matches,
+        suffixes=suffixes,
+        )
+
+
+# ----------------------------------------------------------------------------
+#   Benchmarks
+# ----------------------------------------------------------------------------
+def _peak(func):
+    """ Returns (seconds, peak MB allocated) for `func()`
+    """
+    tracemalloc.start()
+    t0 = time.perf_counter()
+    func()
+    elapsed = time.perf_counter() - t0
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak / 2**20
+
+
+def bench_merge_join(nobs=50_000_000, seed=0):
+    """ Compares `DataFrame.join` with `merge_join` on sorted date-indexed
+        frames, reporting time and peak memory for each join type
+    """
+    rng = np.random.default_rng(seed)
+    dates = pd.date_range('1970-01-01', periods=nobs, freq='s')
+    left = pd.DataFrame({'close': rng.uniform(5, 10, nobs)}, index=dates)
+    # The right frame has every other date and some new dates at the end
+    rdates = dates[::2].append(pd.date_range(dates[-1], periods=1000,
+                                             freq='s')[1:])
+    right = pd.DataFrame({'bday': np.arange(len(rdates))}, index=rdates)
+
+    for how in ('left', 'right', 'inner', 'outer'):
+        t_pd, m_pd = _peak(lambda: left.join(right, how=how))
+        t_mj, m_mj = _peak(lambda: merge_join(left, right, how=how))
+        print(f'{how:>5}: DataFrame.join {t_pd:.3f}s {m_pd:,.0f} MB, '
+              f'merge_join {t_mj:.3f}s {m_mj:,.0f} MB')
+
+
+def bench_align_cache(nobs=100_000, nreps=1_000):
+    """ Compares repeated `ser + other` with `AlignCache.binop` when the
+        same two indexes are aligned `nreps` times
+    """
+    import operator
+
+    dates = pd.date_range('1970-01-01', periods=nobs, freq='D')
+    ser = pd.Series(np.arange(nobs, dtype=float), index=dates)
+    other = ser.iloc[::2] * 2
+
+    t0 = time.perf_counter()
+    for _ in range(nreps):
+        expected = ser + other
+    t_pd = time.perf_counter() - t0
+
+    cache = AlignCache()
+    t0 = time.perf_counter()
+    for _ in range(nreps):
+        res = cache.binop(ser, other, operator.add)
+    t_cache = time.perf_counter() - t0
+
+    pd.testing.assert_series_equal(res, expected, check_freq=False)
+    print(f'ser + other:        {t_pd:.3f}s')
+    print(f'AlignCache.binop:   {t_cache:.3f}s  {cache.stats()}')
+
+
+def bench_asof_join(nevents=1_000_000, nbars=5_000_000, ntickers=100,
+                    seed=0):
+    """ Compares a Python loop over `df.loc` with `asof_join` when matching
+        events to the most recent prior close of the same ticker
+    """
+    rng = np.random.default_rng(seed)
+    tickers = np.array([f'T{i}' for i in range(ntickers)])
+    per_ticker = nbars // ntickers
+    dates = pd.date_range('1990-01-01', periods=per_ticker, freq='D')
+    bars = pd.DataFrame({
+        'ticker': np.repeat(tickers, per_ticker),
+        'close': rng.uniform(5, 10, per_ticker * ntickers),
+        }, index=np.tile(dates, ntickers))
+    secs = rng.integers(0, per_ticker * 86400, size=nevents)
+    events = pd.DataFrame({
+        'ticker': tickers[rng.integers(0, ntickers, size=nevents)],
+        'action': rng.choice(['up', 'down', 'main'], size=nevents),
+        }, index=dates[0] + pd.to_timedelta(secs, unit='s'))
+
+    t0 = time.perf_counter()
+    res = asof_join(events, bars, by='ticker', right_key='price_date')
+    t_asof = time.perf_counter() - t0
+
+    # The loop is only timed on a sample of the events
+    nloop = min(1_000, nevents)
+    by_ticker = {t: grp['close'].sort_index() for t, grp in
+                 bars.groupby('ticker')}
+    t0 = time.perf_counter()
+    for date, row in events.iloc[:nloop].iterrows():
+        ser = by_ticker[row['ticker']].loc[:date]
+        ser.iloc[-1] if len(ser) else np.nan
+    t_loop = (time.perf_counter() - t0) * nevents / nloop
+
+    print(f'loop over df.loc (extrapolated): {t_loop:.1f}s')
+    print(f'asof_join:                       {t_asof:.3f}s '
+          f'({len(res):,} rows)')
+
+
+if __name__ == "__main__":
+    bench_merge_join()
+    bench_align_cache()
+    bench_asof_join()
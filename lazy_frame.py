@@ -0,0 +1,446 @@
+""" lazy_frame.py
+
+Lazy dataframe wrapper which records filter/select/groupby steps as a plan
+
+Nothing is computed until `collect()` is called. Before running, the plan
+is optimized:
+
+- filters are moved before column selections, and before a groupby when
+  they only use the group keys
+- consecutive filters are fused into a single boolean mask
+- columns which are not used by any later step are dropped at the source
+
+Example:
+
+    lf = (LazyFrame(df)
+            .filter(col('action') == 'up')
+            .groupby('firm')
+            .last())
+    res = lf.collect()
+    print(lf.explain())
+"""
+import functools
+import operator
+import time
+
+import numpy as np
+import pandas as pd
+
+from events import label_mask
+
+
+# ----------------------------------------------------------------------------
+#   Expressions
+# ----------------------------------------------------------------------------
+_CMP_OPS = {
+    '==': operator.eq,
+    '!=': operator.ne,
+    '<': operator.lt,
+    '<=': operator.le,
+    '>': operator.gt,
+    '>=': operator.ge,
+    }
+
+
+def _lookup(df, name):
+    """ Returns the column `name` of `df`, or the index level `name`
+    """
+    if isinstance(df, pd.DataFrame) and name in df.columns:
+        return df[name]
+    return pd.Series(df.index.get_level_values(name), index=df.index)
+
+
+class Expr:
+    """ Boolean expression over the columns of a frame. Build expressions
+        with `col(name)` and the comparison, `&`, `|` and `~` operators
+    """
+
+    def __init__(self, op, args):
+        self.op = op
+        self.args = args
+
+    def columns(self):
+        """ Returns the set of column labels used by the expression
+        """
+        if self.op == 'col':
+            return {self.args[0]}
+        cols = set()
+        for arg in self.args:
+            if isinstance(arg, Expr):
+                cols |= arg.columns()
+        return cols
+
+    def evaluate(self, df):
+        """ Returns a boolean array (or the column values for `col`)
+        """
+        op, args = self.op, self.args
+        if op == 'col':
+            return _lookup(df, args[0])
+        if op in _CMP_OPS:
+            res = _CMP_OPS[op](args[0].evaluate(df), args[1])
+            return np.asarray(res, dtype=bool)
+        if op == 'isin':
+            ser = args[0].evaluate(df)
+            if isinstance(ser.dtype, pd.CategoricalDtype):
+                return label_mask(ser, args[1], contains=False)
+            return ser.isin(list(args[1])).to_numpy()
+        if op == 'contains':
+            return label_mask(args[0].evaluate(df), args[1], contains=True)
+        if op == 'and':
+            return self._evaluate_and(df)
+        if op == 'or':
+            return functools.reduce(np.logical_or,
+                                    (arg.evaluate(df) for arg in args))
+        if op == 'not':
+            return ~args[0].evaluate(df)
+        raise ValueError(f'Unknown operation: {op}')
+
+    def _evaluate_and(self, df):
+        """ Evaluates the terms of an `&` one at a time. Once few rows are
+            left, later terms are only evaluated on these rows
+        """
+        terms = []
+        for arg in self.args:
+            # Flatten nested `&` from fused filters
+            terms += arg.args if arg.op == 'and' else [arg]
+        mask = np.array(terms[0].evaluate(df), dtype=bool)
+        for term in terms[1:]:
+            rows = np.flatnonzero(mask)
+            if len(rows) < len(mask) // 2:
+                if isinstance(df, pd.DataFrame):
+                    sub = df.loc[:, [c for c in df.columns
+                                     if c in term.columns()]].iloc[rows]
+                else:
+                    sub = df.iloc[rows]
+                mask[rows] = term.evaluate(sub)
+            else:
+                mask &= term.evaluate(df)
+        return mask
+
+    def __repr__(self):
+        op, args = self.op, self.args
+        if op == 'col':
+            return f'col({args[0]!r})'
+        if op in _CMP_OPS:
+            return f'({args[0]!r} {op} {args[1]!r})'
+        if op in ('isin', 'contains'):
+            labels = repr(sorted(args[1]))
+            if len(args[1]) > 5:
+                labels = f'<{len(args[1])} labels>'
+            return f'{args[0]!r}.{op}({labels})'
+        if op == 'not':
+            return f'~{args[0]!r}'
+        sep = ' & ' if op == 'and' else ' | '
+        return '(' + sep.join(repr(arg) for arg in args) + ')'
+
+    # Comparisons
+    def __eq__(self, other):
+        return Expr('==', (self, other))
+
+    def __ne__(self, other):
+        return Expr('!=', (self, other))
+
+    def __lt__(self, other):
+        return Expr('<', (self, other))
+
+    def __le__(self, other):
+        return Expr('<=', (self, other))
+
+    def __gt__(self, other):
+        return Expr('>', (self, other))
+
+    def __ge__(self, other):
+        return Expr('>=', (self, other))
+
+    def isin(self, labels):
+        return Expr('isin', (self, frozenset(labels)))
+
+    def contains(self, labels):
+        """ Same as `str.contains('a|b')` for the plain labels 'a', 'b'
+        """
+        return Expr('contains', (self, frozenset(labels)))
+
+    # Boolean operators
+    def __and__(self, other):
+        return Expr('and', (self, other))
+
+    def __or__(self, other):
+        return Expr('or', (self, other))
+
+    def __invert__(self):
+        return Expr('not', (self,))
+
+    __hash__ = object.__hash__
+
+
+def col(name):
+    """ Returns an expression referring to the column `name`
+    """
+    return Expr('col', (name,))
+
+
+# ----------------------------------------------------------------------------
+#   Plan steps
+# ----------------------------------------------------------------------------
+# Each step is a tuple:
+#   ('filter', expr)
+#   ('select', [columns])
+#   ('agg', [keys], how)        how is a GroupBy method name, e.g. 'last'
+#   ('project', [columns])      added by the optimizer
+
+# Aggregations which only need the group keys
+_KEY_ONLY_AGGS = ('size',)
+
+
+def _describe(step):
+    kind = step[0]
+    if kind == 'filter':
+        return f'filter {step[1]!r}'
+    if kind == 'agg':
+        return f'groupby({step[1]!r}).{step[2]}()'
+    return f'{kind} {step[1]!r}'
+
+
+def _can_pass(step, prev):
+    """ True if the filter `step` gives the same result when run before
+        `prev`
+    """
+    return prev[0] == 'select' or (
+        prev[0] == 'agg' and step[1].columns() <= set(prev[1]))
+
+
+def _push_filters(steps):
+    """ Moves filters before selections, and before aggregations when they
+        only use the group keys. A filter also moves ahead of another
+        filter which cannot be pushed further itself
+    """
+    steps = list(steps)
+    moved = True
+    while moved:
+        moved = False
+        for i in range(1, len(steps)):
+            step, prev = steps[i], steps[i - 1]
+            if step[0] != 'filter':
+                continue
+            if _can_pass(step, prev) or (
+                    prev[0] == 'filter' and i > 1
+                    and _can_pass(step, steps[i - 2])
+                    and not _can_pass(prev, steps[i - 2])):
+                steps[i - 1], steps[i] = step, prev
+                moved = True
+    return steps
+
+
+def _fuse_filters(steps):
+    """ Combines consecutive filters into one
+    """
+    res = []
+    for step in steps:
+        if step[0] == 'filter' and res and res[-1][0] == 'filter':
+            res[-1] = ('filter', res[-1][1] & step[1])
+        else:
+            res.append(step)
+    return res
+
+
+def _needed_columns(steps):
+    """ Returns the set of columns used by the plan at the input of each
+        step (None if all columns are used)
+    """
+    needed = [None] * len(steps)
+    cur = None
+    for i in range(len(steps) - 1, -1, -1):
+        step = steps[i]
+        kind = step[0]
+        if kind == 'select':
+            cols = set(step[1])
+            cur = cols if cur is None else cur & cols
+        elif kind == 'filter':
+            if cur is not None:
+                cur = cur | step[1].columns()
+        elif kind == 'agg':
+            if step[2] in _KEY_ONLY_AGGS:
+                cur = set(step[1])
+            elif cur is not None:
+                cur = cur | set(step[1])
+        needed[i] = cur
+    return needed
+
+
+def _prune(steps, columns):
+    """ Adds a projection at the source and before each aggregation to drop
+        the columns which are not used later on
+    """
+    needed = _needed_columns(steps)
+    cols = list(columns)
+    res = []
+    for i, step in enumerate(steps):
+        kind = step[0]
+        if (i == 0 or kind == 'agg') and needed[i] is not None:
+            keep = [c for c in cols if c in needed[i]]
+            if len(keep) < len(cols):
+                res.append(('project', keep))
+                cols = keep
+        res.append(step)
+        if kind == 'select':
+            cols = list(step[1])
+        elif kind == 'agg':
+            cols = [] if step[2] in _KEY_ONLY_AGGS \
+                else [c for c in cols if c not in step[1]]
+    return res
+
+
+def optimize(steps, columns):
+    """ Returns the optimized list of steps for a source with `columns`
+    """
+    steps = _fuse_filters(_push_filters(steps))
+    return _prune(steps, columns)
+
+
+# ----------------------------------------------------------------------------
+#   LazyFrame
+# ----------------------------------------------------------------------------
+class LazyFrame:
+    """ Records operations on `df` and runs them on `collect()`
+    """
+
+    def __init__(self, df, steps=()):
+        self.df = df
+        self.steps = tuple(steps)
+        # List of dictionaries with the timing of each step of the last run
+        self.timings = []
+
+    def _with(self, step):
+        return LazyFrame(self.df, self.steps + (step,))
+
+    def filter(self, expr):
+        """ Keeps the rows where `expr` is True
+        """
+        return self._with(('filter', expr))
+
+    def select(self, columns):
+        """ Keeps the columns in `columns`
+        """
+        if isinstance(columns, str):
+            columns = [columns]
+        return self._with(('select', list(columns)))
+
+    def groupby(self, keys):
+        """ Returns a LazyGroupBy, use one of its methods to aggregate
+        """
+        if isinstance(keys, str):
+            keys = [keys]
+        return LazyGroupBy(self, list(keys))
+
+    def plan(self):
+        """ Returns the optimized list of steps
+        """
+        return optimize(self.steps, list(self.df.columns))
+
+    def explain(self):
+        """ Returns a string with the original and the optimized plans
+        """
+        lines = ['Plan:']
+        lines += [f'  {_describe(step)}' for step in self.steps]
+        lines += ['Optimized plan:']
+        lines += [f'  {_describe(step)}' for step in self.plan()]
+        if self.timings:
+            lines += ['Last run:']
+            lines += [f"  {t['step']:<50} {t['seconds']:.4f}s "
+                      f"{t['rows']:>12,} rows" for t in self.timings]
+        return '\n'.join(lines)
+
+    def collect(self):
+        """ Runs the optimized plan and returns the resulting dataframe.
+            The timing of each step is stored in `self.timings`
+        """
+        df = self.df
+        self.timings = []
+        for step in self.plan():
+            t0 = time.perf_counter()
+            kind = step[0]
+            if kind in ('project', 'select'):
+                df = df.loc[:, step[1]]
+            elif kind == 'filter':
+                df = df.loc[step[1].evaluate(df)]
+            elif kind == 'agg':
+                keys, how = step[1], step[2]
+                df = getattr(df.groupby(keys), how)()
+            self.timings.append({
+                'step': _describe(step),
+                'seconds': time.perf_counter() - t0,
+                'rows': len(df),
+                })
+        return df
+
+
+class LazyGroupBy:
+    """ Pending groupby of a LazyFrame
+    """
+
+    def __init__(self, lf, keys):
+        self.lf = lf
+        self.keys = keys
+
+    def _agg(self, how):
+        return self.lf._with(('agg', self.keys, how))
+
+    def last(self):
+        return self._agg('last')
+
+    def first(self):
+        return self._agg('first')
+
+    def size(self):
+        return self._agg('size')
+
+    def count(self):
+        return self._agg('count')
+
+    def nunique(self):
+        return self._agg('nunique')
+
+    def sum(self):
+        return self._agg('sum')
+
+    def mean(self):
+        return self._agg('mean')
+
+
+# ----------------------------------------------------------------------------
+#   Benchmarks
+# ----------------------------------------------------------------------------
+def bench_lazy_frame(nobs=5_000_000, nfirms=5_000):
+    """ Compares the eager chain in pd_groupby.py (mask, `df.loc[cond]`,
+        `groupby('firm').last()`) with the same steps run by a LazyFrame
+    """
+    from events import make_events
+
+    df = make_events(nobs, nfirms=nfirms).reset_index()
+    df['price'] = np.arange(nobs, dtype=np.float64)
+    firms = sorted(df['firm'].unique()[:nfirms // 2])
+
+    t0 = time.perf_counter()
+    cond = df.loc[:, 'action'] == 'up'
+    tmp = df.loc[cond]
+    tmp = tmp.loc[tmp['firm'].isin(firms)]
+    expected = tmp.groupby('firm').last().loc[:, ['date']]
+    t_eager = time.perf_counter() - t0
+
+    lf = (LazyFrame(df)
+          .filter(col('action') == 'up')
+          .groupby('firm')
+          .last()
+          .filter(col('firm').isin(firms))
+          .select(['date']))
+    t0 = time.perf_counter()
+    res = lf.collect()
+    t_lazy = time.perf_counter() - t0
+
+    assert res.equals(expected)
+    print(lf.explain())
+    print(f'eager {t_eager:.3f}s, lazy {t_lazy:.3f}s')
+
+
+if __name__ == "__main__":
+    bench_lazy_frame()
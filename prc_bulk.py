@@ -0,0 +1,224 @@
+""" prc_bulk.py
+
+Bulk loader for the per-ticker price files stored under `cfg.DATADIR`
+
+Files matching a glob pattern are parsed concurrently by a bounded pool of
+threads or processes and stacked into one long dataframe with a categorical
+'ticker' column. Optionally, a separate pool of threads reads the raw bytes
+of the files ahead of the parsers, so disk reads and parsing overlap.
+"""
+import glob
+import io
+import os
+import shutil
+import tempfile
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+
+import numpy as np
+import pandas as pd
+
+from prc_reader import (PRC_DATE_FORMAT, PRC_SCHEMA, fix_date_units,
+                        prc_path, select_schema, split_schema)
+
+
+def ticker_from_path(path):
+    """ Returns the ticker in a file name such as 'qan_prc_2020.csv'
+    """
+    name = os.path.splitext(os.path.basename(path))[0]
+    return name.split('_prc')[0]
+
+
+def find_files(pattern):
+    """ Returns the sorted list of files matching `pattern`. Relative
+        patterns are resolved against `cfg.DATADIR`
+    """
+    return sorted(glob.glob(prc_path(pattern)))
+
+
+# ----------------------------------------------------------------------------
+#   Workers
+# ----------------------------------------------------------------------------
+def _read_bytes(path):
+    """ Returns the contents of the file at `path`
+    """
+    with open(path, 'rb') as fobj:
+        return fobj.read()
+
+
+def _parse(source, schema, date_format):
+    """ Parses one price file (a path or the bytes of the file). The date
+        unit and the index are fixed once, after stacking the files
+    """
+    if isinstance(source, bytes):
+        source = io.BytesIO(source)
+    dtypes, date_cols = split_schema(schema)
+    return pd.read_csv(source, usecols=list(schema), dtype=dtypes,
+                       parse_dates=date_cols, date_format=date_format)
+
+
+def _parse_batch(sources, schema, date_format):
+    """ Parses a batch of files and returns (stacked frame, rows per file).
+        Batches keep the per-task overhead of the pool (and the pickling of
+        results with processes) low for small files
+    """
+    frames = [_parse(source, schema, date_format) for source in sources]
+    return (pd.concat(frames, ignore_index=True),
+            [len(frame) for frame in frames])
+
+
+def _batches(items, size):
+    """ Yields lists of `size` consecutive items
+    """
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _bounded_map(pool, func, items, limit):
+    """ Same as `pool.map(func, items)` with at most `limit` pending tasks,
+        so results which were not consumed yet do not pile up in memory
+    """
+    pending = deque()
+    for item in items:
+        pending.append(pool.submit(func, item))
+        if len(pending) >= limit:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+# ----------------------------------------------------------------------------
+#   Loader
+# ----------------------------------------------------------------------------
+def read_many(pattern='*_prc*.csv', schema=PRC_SCHEMA, columns=None,
+              index_col='Date', date_format=PRC_DATE_FORMAT, workers=None,
+              mode='thread', io_workers=0, files_per_task=16,
+              ticker_func=ticker_from_path):
+    """ Reads all the price files matching `pattern` into a long dataframe
+        with a categorical 'ticker' column (from `ticker_func(path)`).
+
+        Parameters
+        ----------
+        workers : int, optional
+            Number of parsing workers (default: number of CPUs). With 1,
+            files are parsed one after the other in this process.
+        mode : str
+            'thread' or 'process': the kind of pool used for parsing.
+        io_workers : int
+            If positive, the number of threads reading the files into
+            memory ahead of the parsers. If 0, each parser reads its file.
+        files_per_task : int
+            Number of files parsed by each task sent to the pool.
+
+        Only the columns in `columns` (all columns in `schema` if None) are
+        parsed. Files are stacked in sorted path order.
+    """
+    if mode not in ('thread', 'process'):
+        raise ValueError(f'Invalid mode: {mode}')
+    paths = find_files(pattern)
+    if not paths:
+        raise FileNotFoundError(f'No files match {pattern}')
+    schema = select_schema(schema, columns, index_col)
+    parse = partial(_parse_batch, schema=schema, date_format=date_format)
+    workers = workers or os.cpu_count() or 1
+
+    io_pool = ThreadPoolExecutor(io_workers) if io_workers > 0 else None
+    if workers == 1:
+        pool = None
+    elif mode == 'thread':
+        pool = ThreadPoolExecutor(workers)
+    else:
+        pool = ProcessPoolExecutor(workers)
+    try:
+        sources = paths if io_pool is None else \
+            _bounded_map(io_pool, _read_bytes, paths, 2 * io_workers)
+        tasks = _batches(sources, files_per_task)
+        if pool is None:
+            results = [parse(task) for task in tasks]
+        else:
+            results = list(_bounded_map(pool, parse, tasks, 2 * workers))
+    finally:
+        if pool is not None:
+            pool.shutdown()
+        if io_pool is not None:
+            io_pool.shutdown()
+
+    codes, tickers = pd.factorize(
+        pd.Index([ticker_func(path) for path in paths]), sort=True)
+    lengths = [n for _, batch_lengths in results for n in batch_lengths]
+    df = pd.concat([frame for frame, _ in results], ignore_index=True)
+    fix_date_units(df, schema)
+    df.insert(0, 'ticker', pd.Categorical.from_codes(
+        np.repeat(codes, lengths), categories=tickers))
+    if index_col is not None:
+        df.set_index(index_col, inplace=True)
+    return df
+
+
+# ----------------------------------------------------------------------------
+#   Benchmarks
+# ----------------------------------------------------------------------------
+def _write_files(folder, nfiles, nrows, seed=0):
+    """ Writes `nfiles` synthetic price files with `nrows` rows each
+    """
+    rng = np.random.default_rng(seed)
+    dates = pd.bdate_range('2020-01-01', periods=nrows)
+    for i in range(nfiles):
+        prc = 10 + rng.standard_normal(nrows).cumsum() * 0.1
+        pd.DataFrame({
+            'Date': dates, 'Open': prc, 'High': prc + 0.1, 'Low': prc - 0.1,
+            'Close': prc, 'Adj Close': prc,
+            'Volume': rng.integers(1_000, 100_000, nrows),
+            }).to_csv(os.path.join(folder, f't{i:05d}_prc.csv'), index=False,
+                      float_format='%.4f')
+
+
+def bench_read_many(nfiles=5_000, nrows=250, configs=None):
+    """ Compares the serial loop over files with `read_many` on `nfiles`
+        small price files
+    """
+    if configs is None:
+        configs = [
+            dict(workers=1),
+            dict(workers=4, mode='thread'),
+            dict(workers=4, mode='thread', io_workers=2),
+            dict(workers=4, mode='process'),
+            dict(workers=4, mode='process', io_workers=2),
+            ]
+    folder = tempfile.mkdtemp()
+    try:
+        _write_files(folder, nfiles, nrows)
+        pattern = os.path.join(folder, '*_prc*.csv')
+
+        t0 = time.perf_counter()
+        frames = []
+        for path in sorted(glob.glob(pattern)):
+            df = pd.read_csv(path, index_col='Date', parse_dates=['Date'])
+            df['ticker'] = ticker_from_path(path)
+            frames.append(df)
+        expected = pd.concat(frames)
+        print(f'--- {nfiles:,} files, {nrows} rows each')
+        print(f'serial loop: {time.perf_counter() - t0:.3f}s')
+
+        for config in configs:
+            t0 = time.perf_counter()
+            res = read_many(pattern, **config)
+            elapsed = time.perf_counter() - t0
+            assert len(res) == len(expected)
+            assert (res['ticker'].astype(str).to_numpy()
+                    == expected['ticker'].to_numpy()).all()
+            print(f'read_many {config}: {elapsed:.3f}s')
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    bench_read_many()
@@ -0,0 +1,131 @@
+""" prc_cache.py
+
+Binary columnar cache for the price CSV files stored under `cfg.DATADIR`
+
+The first read of a CSV file writes one .npy file per column under
+`DATADIR/.cache/<file name>/`. Later reads memory-map these files as long as
+the modification time and size of the CSV file are unchanged.
+"""
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+import toolkit_config as cfg
+from prc_reader import PRC_SCHEMA, prc_path, read_prices
+
+CACHEDIR = os.path.join(cfg.DATADIR, '.cache')
+
+META_FILE = 'meta.json'
+
+
+# ----------------------------------------------------------------------------
+#   Cache entries
+# ----------------------------------------------------------------------------
+def _entry_dir(path):
+    """ Returns the cache folder for the CSV file at `path`
+    """
+    return os.path.join(CACHEDIR, os.path.basename(path))
+
+
+def _col_file(entry, pos):
+    """ Returns the location of the .npy file for the column at `pos`
+    """
+    return os.path.join(entry, f'col{pos}.npy')
+
+
+def _source_meta(path, schema, index_col):
+    """ Returns the dictionary used to check if a cache entry is still valid
+    """
+    st = os.stat(path)
+    return {
+        'source': os.path.abspath(path),
+        'mtime_ns': st.st_mtime_ns,
+        'size': st.st_size,
+        'schema': {col: str(np.dtype(dtype)) for col, dtype in schema.items()},
+        'index_col': index_col,
+        }
+
+
+def _load_meta(entry):
+    """ Returns the metadata stored in `entry` or None if there is none
+    """
+    try:
+        with open(os.path.join(entry, META_FILE)) as fobj:
+            return json.load(fobj)
+    except (OSError, ValueError):
+        return None
+
+
+def _is_current(cached, meta):
+    """ Returns True if the stored metadata `cached` matches `meta`
+    """
+    return all(cached.get(key) == value for key, value in meta.items())
+
+
+def _write_entry(entry, df, meta):
+    """ Stores the index and columns of `df` in `entry`. The metadata file is
+        written last, so a partially written entry is never considered valid
+    """
+    os.makedirs(entry, exist_ok=True)
+    meta_loc = os.path.join(entry, META_FILE)
+    if os.path.exists(meta_loc):
+        os.remove(meta_loc)
+    cols = [df.index.name] + list(df.columns)
+    arrays = [df.index.to_numpy()] + [df[c].to_numpy() for c in df.columns]
+    for pos, arr in enumerate(arrays):
+        np.save(_col_file(entry, pos), np.ascontiguousarray(arr))
+    meta = dict(meta, columns=cols)
+    tmp_loc = meta_loc + '.tmp'
+    with open(tmp_loc, 'w') as fobj:
+        json.dump(meta, fobj)
+    os.replace(tmp_loc, meta_loc)
+
+
+def _read_entry(entry, meta):
+    """ Returns a dataframe backed by memory-mapped arrays stored in `entry`
+    """
+    cols = meta['columns']
+    # np.asarray drops the np.memmap subclass but keeps the mapping.
+    # Copy-on-write pages keep the frame writable without changing the file
+    arrays = [np.asarray(np.load(_col_file(entry, pos), mmap_mode='c'))
+              for pos in range(len(cols))]
+    index = pd.Index(arrays[0], name=cols[0], copy=False)
+    data = dict(zip(cols[1:], arrays[1:]))
+    return pd.DataFrame(data=data, index=index, copy=False)
+
+
+# ----------------------------------------------------------------------------
+#   Reader
+# ----------------------------------------------------------------------------
+def read_prices_cached(fname, schema=PRC_SCHEMA, index_col='Date'):
+    """ Reads the price file `fname`, using the binary cache if it is up to
+        date and refreshing it otherwise
+    """
+    path = prc_path(fname)
+    entry = _entry_dir(path)
+    meta = _source_meta(path, schema, index_col)
+    cached = _load_meta(entry)
+    if cached is not None and _is_current(cached, meta):
+        return _read_entry(entry, cached)
+
+    df = read_prices(path, schema=schema, index_col=index_col)
+    _write_entry(entry, df, meta)
+    return df
+
+
+def clear_cache(fname=None):
+    """ Removes the cache entry for `fname` or all entries if None
+    """
+    if fname is None:
+        entries = [os.path.join(CACHEDIR, e) for e in os.listdir(CACHEDIR)] \
+            if os.path.isdir(CACHEDIR) else []
+    else:
+        entries = [_entry_dir(prc_path(fname))]
+    for entry in entries:
+        if not os.path.isdir(entry):
+            continue
+        for name in os.listdir(entry):
+            os.remove(os.path.join(entry, name))
+        os.rmdir(entry)
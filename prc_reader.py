@@ -0,0 +1,378 @@
+""" prc_reader.py
+
+Typed, chunked readers for the price CSV files stored under `cfg.DATADIR`
+
+Reads can be restricted to some columns and to a range of dates. For date
+ranges, a sidecar block index (`<file>.blocks.json`) with the min/max date
+of each block of rows is built on first use, and blocks outside the range
+are skipped without being read.
+"""
+import io
+import itertools
+import json
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+import toolkit_config as cfg
+from date_tools import parse_bounds
+
+
+# ----------------------------------------------------------------------------
+#   The price file schema
+# ----------------------------------------------------------------------------
+# Column name --> dtype. The 'Date' column is parsed while reading the file,
+# so no second pass with `pd.to_datetime` is required.
+PRC_SCHEMA = {
+    'Date': 'datetime64[ns]',
+    'Open': 'float32',
+    'High': 'float32',
+    'Low': 'float32',
+    'Close': 'float32',
+    'Adj Close': 'float32',
+    'Volume': 'int64',
+    }
+
+PRC_DATE_FORMAT = '%Y-%m-%d'
+
+# Default number of rows in each chunk
+CHUNKSIZE = 100_000
+
+# Number of rows in each block of the block index (about one year of daily
+# prices)
+BLOCK_ROWS = 250
+
+
+def prc_path(fname):
+    """ Returns the location of `fname`. Relative names are resolved
+        against `cfg.DATADIR`
+    """
+    if os.path.isabs(fname):
+        return fname
+    return os.path.join(cfg.DATADIR, fname)
+
+
+def split_schema(schema):
+    """ Returns a tuple (dtypes, date_cols) with the `dtype` dictionary for
+        `pd.read_csv` and the list of columns to be parsed as dates
+    """
+    dtypes = {}
+    date_cols = []
+    for col, dtype in schema.items():
+        if np.dtype(dtype).kind == 'M':
+            date_cols.append(col)
+        else:
+            dtypes[col] = dtype
+    return dtypes, date_cols
+
+
+def fix_date_units(df, schema):
+    """ Casts the date columns of `df` to the dtype declared in `schema`.
+        Newer pandas versions may pick a different datetime unit when
+        parsing dates
+    """
+    for col in split_schema(schema)[1]:
+        if col in df.columns and df[col].dtype != schema[col]:
+            df[col] = df[col].astype(schema[col])
+    return df
+
+
+def rows_per_chunk(schema, max_bytes):
+    """ Returns the number of rows that fit in `max_bytes` given `schema`
+    """
+    row_bytes = sum(np.dtype(dtype).itemsize for dtype in schema.values())
+    return max(1, max_bytes // row_bytes)
+
+
+# ----------------------------------------------------------------------------
+#   Block index
+# ----------------------------------------------------------------------------
+def _index_path(path):
+    """ Returns the location of the block index of the file at `path`
+    """
+    return path + '.blocks.json'
+
+
+def _source_meta(path, date_col, date_format, block_rows):
+    """ Returns the dictionary used to check if a block index is still valid
+    """
+    st = os.stat(path)
+    return {
+        'mtime_ns': st.st_mtime_ns,
+        'size': st.st_size,
+        'date_col': date_col,
+        'date_format': date_format,
+        'block_rows': block_rows,
+        }
+
+
+def build_block_index(fname, date_col='Date', date_format=PRC_DATE_FORMAT,
+                      block_rows=BLOCK_ROWS):
+    """ Scans the price file `fname` and writes its block index. Returns the
+        index, a dictionary with the header line and a list of blocks
+        [offset, nbytes, min date, max date] (dates as ISO strings).
+
+        The file is split on line breaks, so fields must not contain
+        quoted newlines.
+    """
+    path = prc_path(fname)
+    meta = _source_meta(path, date_col, date_format, block_rows)
+    blocks = []
+    with open(path, 'rb') as fobj:
+        header = fobj.readline()
+        names = [name.strip().strip('"') for name in
+                 header.decode().rstrip('\r\n').split(',')]
+        pos = names.index(date_col)
+        offset = len(header)
+        while True:
+            lines = list(itertools.islice(fobj, block_rows))
+            if not lines:
+                break
+            nbytes = sum(len(line) for line in lines)
+            fields = [line.split(b',', pos + 1)[pos].strip().strip(b'"')
+                      for line in lines if line.strip()]
+            if fields:
+                dates = pd.to_datetime(pd.Index(fields).str.decode('utf-8'),
+                                       format=date_format)
+                blocks.append([offset, nbytes, dates.min().isoformat(),
+                               dates.max().isoformat()])
+            offset += nbytes
+    index = dict(meta, header=header.decode(), blocks=blocks)
+    loc = _index_path(path)
+    tmp_loc = loc + '.tmp'
+    with open(tmp_loc, 'w') as fobj:
+        json.dump(index, fobj)
+    os.replace(tmp_loc, loc)
+    return index
+
+
+def load_block_index(fname, date_col='Date', date_format=PRC_DATE_FORMAT,
+                     block_rows=BLOCK_ROWS):
+    """ Returns the block index of `fname`, (re)building it if it is missing
+        or older than the file
+    """
+    path = prc_path(fname)
+    meta = _source_meta(path, date_col, date_format, block_rows)
+    try:
+        with open(_index_path(path)) as fobj:
+            index = json.load(fobj)
+    except (OSError, ValueError):
+        index = None
+    if index is None or any(index.get(k) != v for k, v in meta.items()):
+        index = build_block_index(path, date_col=date_col,
+                                  date_format=date_format,
+                                  block_rows=block_rows)
+    return index
+
+
+def date_bounds(start=None, end=None):
+    """ Returns inclusive (start, end) timestamps. Strings are partial dates
+        as in `prc.loc['2020-01']`: `end='2020-01'` includes all of January
+    """
+    if start is not None:
+        start = pd.Timestamp(parse_bounds(start)[0])
+    if end is not None:
+        end = pd.Timestamp(parse_bounds(end)[1] - 1)
+    return start, end
+
+
+def block_ranges(index, start=None, end=None, max_nbytes=None):
+    """ Returns the list of (offset, nbytes) byte ranges of the blocks in
+        `index` which may contain dates between `start` and `end`.
+        Consecutive blocks are merged into one range of at most `max_nbytes`
+        bytes (unlimited if None; a single block is never split)
+    """
+    start, end = date_bounds(start, end)
+    ranges = []
+    for offset, nbytes, lo, hi in index['blocks']:
+        if start is not None and pd.Timestamp(hi) < start:
+            continue
+        if end is not None and pd.Timestamp(lo) > end:
+            continue
+        if ranges and ranges[-1][0] + ranges[-1][1] == offset and (
+                max_nbytes is None or ranges[-1][1] + nbytes <= max_nbytes):
+            ranges[-1] = (ranges[-1][0], ranges[-1][1] + nbytes)
+        else:
+            ranges.append((offset, nbytes))
+    return ranges
+
+
+def range_bytes(index, nrows):
+    """ Returns the number of bytes of `nrows` rows of the file, estimated
+        from the largest block in `index`
+    """
+    blocks = index['blocks']
+    if not blocks:
+        return 0
+    max_nbytes = max(nbytes for _, nbytes, _, _ in blocks)
+    return max(1, int(np.ceil(nrows * max_nbytes / index['block_rows'])))
+
+
+# ----------------------------------------------------------------------------
+#   Readers
+# ----------------------------------------------------------------------------
+def select_schema(schema, columns, index_col, date_col=None):
+    """ Returns the part of `schema` needed to read `columns` (all if None),
+        `index_col` and `date_col`
+    """
+    if columns is None:
+        return schema
+    keep = set(columns) | {index_col, date_col}
+    keep.discard(None)
+    missing = keep - set(schema)
+    if missing:
+        raise KeyError(f'Columns not in the schema: {sorted(missing)}')
+    return {col: dtype for col, dtype in schema.items() if col in keep}
+
+
+def _read_chunks(source, schema, chunksize, index_col, date_format,
+                 start=None, end=None, date_col=None):
+    """ Yields typed chunks of the CSV `source`, keeping only the rows with
+        `date_col` between `start` and `end` (inclusive) if given
+    """
+    dtypes, date_cols = split_schema(schema)
+    reader = pd.read_csv(
+        source,
+        usecols=list(schema),
+        dtype=dtypes,
+        parse_dates=date_cols,
+        date_format=date_format,
+        chunksize=chunksize,
+        )
+    with reader:
+        for chunk in reader:
+            fix_date_units(chunk, schema)
+            if start is not None or end is not None:
+                dates = chunk[date_col]
+                keep = np.ones(len(chunk), dtype=bool)
+                if start is not None:
+                    keep &= (dates >= start).to_numpy()
+                if end is not None:
+                    keep &= (dates <= end).to_numpy()
+                if not keep.all():
+                    chunk = chunk.loc[keep]
+                if not len(chunk):
+                    continue
+            if index_col is not None:
+                chunk.set_index(index_col, inplace=True)
+            yield chunk
+
+
+def iter_prices(fname, schema=PRC_SCHEMA, chunksize=CHUNKSIZE,
+                index_col='Date', date_format=PRC_DATE_FORMAT, max_bytes=None,
+                columns=None, start=None, end=None, date_col='Date'):
+    """ Generator which yields the contents of the price file `fname` as
+        dataframes with at most `chunksize` rows.
+
+        Only the columns in `schema` are read, with the declared dtypes.
+        If `max_bytes` is given, `chunksize` is derived from it instead.
+
+        Parameters
+        ----------
+        columns : list, optional
+            Columns to return (besides `index_col`). Other columns of the
+            file are not parsed.
+        start, end : str or timestamp, optional
+            Inclusive range of dates in `date_col`. Strings may be partial
+            dates such as '2020' or '2020-01'. Only the byte ranges whose
+            block index entry overlaps the range are read, in pieces of
+            about `chunksize` rows, so memory stays bounded.
+    """
+    if start is None and end is None:
+        schema = select_schema(schema, columns, index_col)
+        if max_bytes is not None:
+            chunksize = rows_per_chunk(schema, max_bytes)
+        yield from _read_chunks(prc_path(fname), schema, chunksize,
+                                index_col, date_format)
+        return
+
+    # `date_col` is read to apply the range, and dropped if not requested
+    drop = columns is not None and date_col != index_col \
+        and date_col not in columns
+    schema = select_schema(schema, columns, index_col, date_col)
+    if max_bytes is not None:
+        chunksize = rows_per_chunk(schema, max_bytes)
+    start, end = date_bounds(start, end)
+    path = prc_path(fname)
+    index = load_block_index(path, date_col=date_col, date_format=date_format)
+    header = index['header'].encode()
+    ranges = block_ranges(index, start, end,
+                          max_nbytes=range_bytes(index, chunksize))
+    with open(path, 'rb') as fobj:
+        for offset, nbytes in ranges:
+            fobj.seek(offset)
+            data = io.BytesIO()
+            data.write(header)
+            data.write(fobj.read(nbytes))
+            data.seek(0)
+            for chunk in _read_chunks(data, schema, chunksize, index_col,
+                                      date_format, start, end, date_col):
+                yield chunk.drop(columns=date_col) if drop else chunk
+
+
+def read_prices(fname, schema=PRC_SCHEMA, chunksize=CHUNKSIZE,
+                index_col='Date', date_format=PRC_DATE_FORMAT,
+                columns=None, start=None, end=None, date_col='Date'):
+    """ Reads the price file `fname` (optionally only `columns` and the
+        dates between `start` and `end`) into a single dataframe
+    """
+    chunks = list(iter_prices(fname, schema=schema, chunksize=chunksize,
+                              index_col=index_col, date_format=date_format,
+                              columns=columns, start=start, end=end,
+                              date_col=date_col))
+    if not chunks:
+        # No rows in the date range
+        schema = select_schema(schema, columns, index_col)
+        empty = pd.DataFrame({col: pd.Series(dtype=dtype)
+                              for col, dtype in schema.items()})
+        return empty.set_index(index_col) if index_col is not None else empty
+    return pd.concat(chunks)
+
+
+# ----------------------------------------------------------------------------
+#   Benchmarks
+# ----------------------------------------------------------------------------
+def bench_date_range(nyears=20, month='2015-06'):
+    """ Compares reading a whole synthetic `nyears` daily price file and
+        slicing one month (as in pd_data.py) with `read_prices` restricted
+        to that month and the 'Close' column
+    """
+    dates = pd.bdate_range('2000-01-03', periods=nyears * 261)
+    rng = np.random.default_rng(0)
+    prc = 10 + rng.standard_normal(len(dates)).cumsum() * 0.1
+    df = pd.DataFrame({
+        'Date': dates, 'Open': prc, 'High': prc + 0.1, 'Low': prc - 0.1,
+        'Close': prc, 'Adj Close': prc,
+        'Volume': rng.integers(1_000, 100_000, len(dates)),
+        })
+    folder = tempfile.mkdtemp()
+    try:
+        loc = os.path.join(folder, 'prc.csv')
+        df.to_csv(loc, index=False, date_format=PRC_DATE_FORMAT)
+        build_block_index(loc)
+
+        t0 = time.perf_counter()
+        full = pd.read_csv(loc, index_col='Date', parse_dates=['Date'])
+        expected = full.loc[month, ['Close']]
+        t_full = time.perf_counter() - t0
+
+        t0 = time.perf_counter()
+        res = read_prices(loc, columns=['Close'], start=month, end=month)
+        t_range = time.perf_counter() - t0
+
+        assert np.allclose(res['Close'], expected['Close'], rtol=1e-6)
+        nbytes = sum(n for _, n in block_ranges(
+            load_block_index(loc), month, month))
+        print(f'{len(full):,} rows, {len(res)} rows in {month}')
+        print(f'read_csv + loc: {t_full:.4f}s, read_prices: {t_range:.4f}s, '
+              f'bytes read: {nbytes / os.path.getsize(loc):.1%}')
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    bench_date_range()
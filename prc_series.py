@@ -0,0 +1,249 @@
+""" prc_series.py
+
+Price series with fast date-range queries
+"""
+import time
+
+import numpy as np
+
+
+# ----------------------------------------------------------------------------
+#   The PriceSeries class
+# ----------------------------------------------------------------------------
+class PriceSeries:
+    """ Sorted dates and prices, plus a prefix-sum array of the prices so the
+        average price over any date range takes two binary searches. Missing
+        prices (NaN) are skipped, like `Series.mean`
+    """
+
+    def __init__(self, dates, prices):
+        dates = np.asarray(dates, dtype='datetime64[ns]')
+        prices = np.asarray(prices, dtype=np.float64)
+        if len(dates) != len(prices):
+            raise ValueError('dates and prices must have the same length')
+        order = np.argsort(dates, kind='stable')
+        self.dates = dates[order]
+        self.prices = prices[order]
+        # cumsum[i] is the sum of the valid prices among the first i prices
+        # and counts[i] the number of valid prices
+        valid = ~np.isnan(self.prices)
+        self.cumsum = np.concatenate(
+            ([0.0], np.cumsum(np.where(valid, self.prices, 0.0))))
+        self.counts = np.concatenate(([0], np.cumsum(valid)))
+
+    def __len__(self):
+        return len(self.dates)
+
+    def bounds(self, start, end):
+        """ Returns the positions (i, j) such that self.dates[i:j] holds the
+            dates between `start` and `end` (both included)
+        """
+        start = np.asarray(start, dtype='datetime64[ns]')
+        end = np.asarray(end, dtype='datetime64[ns]')
+        i = np.searchsorted(self.dates, start, side='left')
+        j = np.searchsorted(self.dates, end, side='right')
+        return i, np.maximum(i, j)
+
+    def mean(self, start, end):
+        """ Returns the average price between `start` and `end` (both
+            included), or NaN if there are no valid prices in that range
+        """
+        i, j = self.bounds(start, end)
+        nobs = self.counts[j] - self.counts[i]
+        if nobs == 0:
+            return np.nan
+        return float((self.cumsum[j] - self.cumsum[i]) / nobs)
+
+    def means(self, starts, ends):
+        """ Same as `mean` for arrays of start and end dates. Returns an array
+            with one average per (start, end) pair
+        """
+        i, j = self.bounds(starts, ends)
+        nobs = self.counts[j] - self.counts[i]
+        total = self.cumsum[j] - self.cumsum[i]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(nobs > 0, total / nobs, np.nan)
+
+
+# ----------------------------------------------------------------------------
+#   The WindowStats class
+# ----------------------------------------------------------------------------
+def _sparse_table(values, func):
+    """ Returns a 2D array where row k holds func(values[i:i + 2**k]) at
+        column i. Columns past the end of the series hold the last value
+    """
+    nobs = len(values)
+    nlevels = max(1, int(nobs).bit_length())
+    table = np.empty((nlevels, nobs), dtype=values.dtype)
+    table[0] = values
+    for k in range(1, nlevels):
+        half = 1 << (k - 1)
+        prev = table[k - 1]
+        table[k, :nobs - half] = func(prev[:nobs - half], prev[half:])
+        table[k, nobs - half:] = prev[nobs - half:]
+    return table
+
+
+class WindowStats(PriceSeries):
+    """ Price series with precomputed prefix sums (mean, variance) and sparse
+        tables (min, max), so any windowed statistic takes O(1) after the
+        window bounds are found
+    """
+
+    STATS = ('mean', 'var', 'std', 'min', 'max', 'count')
+
+    def __init__(self, dates, prices):
+        super().__init__(dates, prices)
+        # Shift the prices before squaring to limit the loss of precision
+        # when subtracting two large prefix sums. Missing prices add zero to
+        # the sums and never win a min or a max
+        valid = ~np.isnan(self.prices)
+        self.shift = np.nanmean(self.prices) if valid.any() else 0.0
+        centered = np.where(valid, self.prices - self.shift, 0.0)
+        self.cumsum_c = np.concatenate(([0.0], np.cumsum(centered)))
+        self.cumsum_sq = np.concatenate(([0.0], np.cumsum(centered ** 2)))
+        self.min_table = _sparse_table(
+            np.where(valid, self.prices, np.inf), np.minimum)
+        self.max_table = _sparse_table(
+            np.where(valid, self.prices, -np.inf), np.maximum)
+
+    @classmethod
+    def from_series(cls, ser):
+        """ Creates an instance from a series of prices indexed by date
+        """
+        return cls(ser.index.to_numpy(), ser.to_numpy())
+
+    def _minmax(self, table, func, i, j, nobs):
+        """ Looks up the min (or max) in windows [i, j) using `table`.
+            Windows without valid prices (`nobs` == 0) produce NaN
+        """
+        ok = nobs > 0
+        if not ok.any():
+            return np.full(len(nobs), np.nan)
+        k = np.frexp(np.where(ok, j - i, 1))[1] - 1
+        right = np.where(ok, j - (1 << k), 0)
+        left = np.where(ok, i, 0)
+        res = func(table[k, left], table[k, right])
+        return np.where(ok, res, np.nan)
+
+    def query(self, starts, ends, stats=STATS):
+        """ Returns a dictionary with an array for each statistic in `stats`,
+            computed over the dates between each start and end (both
+            included). Missing prices are skipped and windows without valid
+            prices produce NaN. Variances use ddof=1 like `Series.var`
+        """
+        i, j = self.bounds(starts, ends)
+        i = np.atleast_1d(i)
+        j = np.atleast_1d(j)
+        nobs = self.counts[j] - self.counts[i]
+        res = {}
+        with np.errstate(invalid='ignore', divide='ignore'):
+            s1 = self.cumsum_c[j] - self.cumsum_c[i]
+            mean_c = s1 / nobs
+            for stat in stats:
+                if stat == 'count':
+                    res[stat] = nobs
+                elif stat == 'mean':
+                    res[stat] = np.where(nobs > 0, mean_c + self.shift, np.nan)
+                elif stat in ('var', 'std'):
+                    s2 = self.cumsum_sq[j] - self.cumsum_sq[i]
+                    var = (s2 - s1 * mean_c) / (nobs - 1)
+                    var = np.where(nobs > 1, np.maximum(var, 0.0), np.nan)
+                    res[stat] = var if stat == 'var' else np.sqrt(var)
+                elif stat == 'min':
+                    res[stat] = self._minmax(self.min_table, np.minimum, i, j, nobs)
+                elif stat == 'max':
+                    res[stat] = self._minmax(self.max_table, np.maximum, i, j, nobs)
+                else:
+                    raise ValueError(f'Unknown statistic: {stat}')
+        return res
+
+
+# ----------------------------------------------------------------------------
+#   Benchmarks
+# ----------------------------------------------------------------------------
+def bench_price_series(nobs=100_000, nqueries=1_000, seed=0):
+    """ Compares `list.index` slicing and dictionary lookups with
+        `PriceSeries.mean` and `PriceSeries.means`
+    """
+    rng = np.random.default_rng(seed)
+    dates_arr = np.datetime64('1970-01-01') + np.arange(nobs)
+    dates = [str(d) for d in dates_arr]
+    prices = list(rng.uniform(5, 10, size=nobs))
+    prc_dic = dict(zip(dates, prices))
+
+    pos = np.sort(rng.integers(0, nobs, size=(nqueries, 2)), axis=1)
+    starts = [dates[i] for i in pos[:, 0]]
+    ends = [dates[j] for j in pos[:, 1]]
+
+    t0 = time.perf_counter()
+    expected = []
+    for start_date, end_date in zip(starts, ends):
+        start = dates.index(start_date)
+        end = dates.index(end_date) + 1
+        prcs = prices[start:end]
+        expected.append(sum(prcs) / len(prcs))
+    t_list = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    for start_date, end_date in zip(starts, ends):
+        prcs = [p for d, p in prc_dic.items() if start_date <= d <= end_date]
+        sum(prcs) / len(prcs)
+    t_dic = time.perf_counter() - t0
+
+    ps = PriceSeries(dates, prices)
+    t0 = time.perf_counter()
+    for start_date, end_date in zip(starts, ends):
+        ps.mean(start_date, end_date)
+    t_mean = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    res = ps.means(starts, ends)
+    t_means = time.perf_counter() - t0
+
+    np.testing.assert_allclose(res, expected)
+    print(f'list.index + slice:   {t_list:.4f}s')
+    print(f'dict scan:            {t_dic:.4f}s')
+    print(f'PriceSeries.mean:     {t_mean:.4f}s')
+    print(f'PriceSeries.means:    {t_means:.4f}s')
+
+
+def bench_window_stats(nobs=100_000, nqueries=1_000, seed=0):
+    """ Compares `ser.loc[a:b]` statistics with `WindowStats.query`
+    """
+    import pandas as pd
+
+    rng = np.random.default_rng(seed)
+    dates = pd.date_range('1970-01-01', periods=nobs, freq='D')
+    ser = pd.Series(rng.uniform(5, 10, size=nobs), index=dates)
+    ser[rng.random(nobs) < 0.05] = np.nan
+    pos = np.sort(rng.integers(0, nobs, size=(nqueries, 2)), axis=1)
+    starts = dates[pos[:, 0]]
+    ends = dates[pos[:, 1]]
+
+    t0 = time.perf_counter()
+    expected = {stat: [] for stat in ('mean', 'var', 'min', 'max')}
+    for a, b in zip(starts, ends):
+        win = ser.loc[a:b]
+        for stat, values in expected.items():
+            values.append(getattr(win, stat)())
+    t_loc = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    stats = WindowStats.from_series(ser)
+    t_build = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    res = stats.query(starts, ends, stats=tuple(expected))
+    t_query = time.perf_counter() - t0
+
+    for stat, values in expected.items():
+        np.testing.assert_allclose(res[stat], values, rtol=1e-9, atol=1e-12)
+    print(f'ser.loc[a:b] stats:   {t_loc:.4f}s')
+    print(f'WindowStats build:    {t_build:.4f}s')
+    print(f'WindowStats.query:    {t_query:.4f}s')
+
+
+if __name__ == "__main__":
+    bench_price_series()
+    bench_window_stats()
@@ -0,0 +1,234 @@
+""" rets_tools.py
+
+Tools to compute returns from price data
+"""
+import bisect
+import time
+
+import numpy as np
+import pandas as pd
+
+from grp_tools import group_codes
+
+
+# ----------------------------------------------------------------------------
+#   Incremental returns
+# ----------------------------------------------------------------------------
+class ReturnsAccumulator:
+    """ Keeps the price history of each ticker and computes returns only for
+        the rows added by each call to `update`.
+
+        Returns are computed as in `Series.pct_change`, after sorting by
+        date. A late (out-of-order) bar only changes its own return and the
+        return of the next bar. A bar with an existing date replaces it.
+    """
+
+    def __init__(self, ticker_col=None, close_col='Close'):
+        self.ticker_col = ticker_col
+        self.close_col = close_col
+        self.index_name = None
+        self.unit = None
+        # ticker --> sorted list of dates (int64 ns) and matching closes
+        self._dates = {}
+        self._closes = {}
+
+    def __len__(self):
+        return sum(len(dates) for dates in self._dates.values())
+
+    def _ret(self, closes, pos):
+        """ Return of the bar at position `pos`
+        """
+        if pos == 0:
+            return np.nan
+        # np.float64 gives inf (not ZeroDivisionError) after a zero close,
+        # like the fast path and `pct_change`
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.float64(closes[pos]) / closes[pos - 1] - 1
+
+    def _append(self, ticker, new_dates, new_closes):
+        """ Adds bars to `ticker`. Returns a dictionary with position -->
+            return for every bar whose return was created or changed
+        """
+        dates = self._dates.setdefault(ticker, [])
+        closes = self._closes.setdefault(ticker, [])
+
+        # Fast path: all new bars come after the last stored bar
+        if len(new_dates) and (not dates or new_dates[0] > dates[-1]) \
+                and np.all(np.diff(new_dates) > 0):
+            first = len(dates)
+            prev = np.empty(len(new_closes))
+            prev[0] = closes[-1] if closes else np.nan
+            prev[1:] = new_closes[:-1]
+            with np.errstate(invalid='ignore', divide='ignore'):
+                rets = new_closes / prev - 1
+            dates.extend(new_dates.tolist())
+            closes.extend(new_closes.tolist())
+            return dict(zip(range(first, len(dates)), rets))
+
+        # Slow path: insert each bar, then recompute affected neighbours
+        touched = set()
+        for date, close in zip(new_dates.tolist(), new_closes.tolist()):
+            pos = bisect.bisect_left(dates, date)
+            if pos < len(dates) and dates[pos] == date:
+                closes[pos] = close
+            else:
+                dates.insert(pos, date)
+                closes.insert(pos, close)
+                # positions after `pos` moved by one
+                touched = {p + 1 if p >= pos else p for p in touched}
+            touched.update((pos, pos + 1))
+        return {pos: self._ret(closes, pos) for pos in sorted(touched)
+                if pos < len(dates)}
+
+    def update(self, df):
+        """ Adds the rows in `df` (indexed by date) and returns a series with
+            the returns of the new rows and of any existing rows whose return
+            changed
+        """
+        index = pd.DatetimeIndex(df.index)
+        if self.unit is None:
+            self.index_name = index.name
+            self.unit = index.unit
+        dates = index.as_unit('ns').asi8
+        closes = df[self.close_col].to_numpy(dtype=np.float64)
+        if self.ticker_col is None:
+            tickers = np.zeros(len(df), dtype=np.int64)
+        else:
+            tickers = df[self.ticker_col].to_numpy()
+
+        changed = []
+        codes, uniques = pd.factorize(tickers)
+        for code, ticker in enumerate(uniques):
+            rows = np.flatnonzero(codes == code)
+            order = np.argsort(dates[rows], kind='stable')
+            rows = rows[order]
+            ticker = None if self.ticker_col is None else ticker
+            res = self._append(ticker, dates[rows], closes[rows])
+            all_dates = self._dates[ticker]
+            changed.extend((ticker, all_dates[pos], ret)
+                           for pos, ret in res.items())
+        return self._to_series(changed)
+
+    def returns(self):
+        """ Returns a series with the returns of all stored bars
+        """
+        rows = []
+        for ticker, dates in self._dates.items():
+            closes = self._closes[ticker]
+            rows.extend((ticker, date, self._ret(closes, pos))
+                        for pos, date in enumerate(dates))
+        return self._to_series(rows)
+
+    def _to_series(self, rows):
+        """ Converts a list of (ticker, date, return) tuples to a series
+            sorted by ticker and date
+        """
+        tickers, dates, rets = zip(*rows) if rows else ((), (), ())
+        dates = pd.DatetimeIndex(np.array(dates, dtype='datetime64[ns]'),
+                                 name=self.index_name)
+        dates = dates.as_unit(self.unit or 'ns')
+        if self.ticker_col is None:
+            index = dates
+        else:
+            index = pd.MultiIndex.from_arrays(
+                [pd.Index(tickers, name=self.ticker_col), dates])
+        ser = pd.Series(np.array(rets, dtype=np.float64), index=index,
+                        name=self.close_col)
+        return ser.sort_index()
+
+
+# ----------------------------------------------------------------------------
+#   Returns for many tickers
+# ----------------------------------------------------------------------------
+def multi_returns(df, ticker_col='ticker', date_col=None, close_col='Close',
+                  horizons=(1,), log=True, presorted=False):
+    """ Computes returns for every ticker in the long-format frame `df`.
+
+        The frame is sorted once by (ticker, date), using the index if
+        `date_col` is None, unless `presorted` is True. For each horizon h,
+        the result has a column 'ret_h' with simple returns and, if `log` is
+        True, a column 'logret_h' with log returns. The first h rows of each
+        ticker are NaN, like `groupby(ticker_col)[close_col].pct_change(h)`.
+
+        Returns a dataframe with the sorted rows of `df` and the new columns.
+    """
+    codes, _ = group_codes(df, ticker_col)
+    if not presorted:
+        if date_col is None:
+            dates = df.index.to_numpy()
+        else:
+            dates = df[date_col].to_numpy()
+        pos = np.lexsort((dates, codes))
+        df = df.iloc[pos]
+        codes = codes[pos]
+    closes = df[close_col].to_numpy(dtype=np.float64)
+
+    res = df.copy()
+    for h in horizons:
+        rets = np.full(len(closes), np.nan)
+        # Row i and row i - h belong to the same ticker only if their codes
+        # match, since the tickers are contiguous after sorting
+        same = (codes[h:] == codes[:-h]) & (codes[h:] >= 0)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            ratio = closes[h:] / closes[:-h]
+        rets[h:] = np.where(same, ratio - 1, np.nan)
+        res[f'ret_{h}'] = rets
+        if log:
+            with np.errstate(invalid='ignore', divide='ignore'):
+                res[f'logret_{h}'] = np.log1p(rets)
+    return res
+
+
+# ----------------------------------------------------------------------------
+#   Benchmarks
+# ----------------------------------------------------------------------------
+def bench_returns_accumulator(ndates=2_000, ntickers=50, nbatches=20, seed=0):
+    """ Replays in-order, shuffled and late batches through a
+        `ReturnsAccumulator` and checks every update against
+        `sort_index().groupby(...).pct_change()` on the rows seen so far
+    """
+    rng = np.random.default_rng(seed)
+    dates = pd.bdate_range('2000-01-03', periods=ndates, name='Date')
+    df = pd.DataFrame({
+        'ticker': np.repeat([f't{i:03d}' for i in range(ntickers)], ndates),
+        'Close': rng.uniform(5, 10, size=ndates * ntickers).round(2),
+        }, index=dates[np.tile(np.arange(ndates), ntickers)])
+    # Zero closes produce inf returns in `pct_change`
+    df.iloc[rng.integers(0, len(df), size=ntickers), 1] = 0.0
+
+    # The first half of the dates arrives in order, the rest is shuffled,
+    # so later batches hold bars older than bars already stored
+    early = df.index < dates[ndates // 2]
+    late = np.flatnonzero(~early)
+    rng.shuffle(late)
+    batches = [df[early]] + [df.iloc[rows]
+                             for rows in np.array_split(late, nbatches)]
+
+    acc = ReturnsAccumulator(ticker_col='ticker')
+    seen = []
+    t_acc = t_full = 0.0
+    for batch in batches:
+        t0 = time.perf_counter()
+        res = acc.update(batch)
+        t_acc += time.perf_counter() - t0
+
+        seen.append(batch)
+        t0 = time.perf_counter()
+        full = pd.concat(seen).set_index('ticker', append=True)
+        full = full.swaplevel().sort_index()
+        expected = full.groupby(level='ticker')['Close'].pct_change()
+        t_full += time.perf_counter() - t0
+
+        assert res.index.isin(expected.index).all()
+        np.testing.assert_array_equal(res.to_numpy(),
+                                      expected.loc[res.index].to_numpy())
+    np.testing.assert_array_equal(acc.returns().to_numpy(),
+                                  expected.to_numpy())
+    assert acc.returns().index.equals(expected.index)
+    print(f'--- {len(df):,} bars in {len(batches)} batches')
+    print(f'sort_index + pct_change: {t_full:.4f}s')
+    print(f'ReturnsAccumulator:      {t_acc:.4f}s')
+
+
+if __name__ == "__main__":
+    bench_returns_accumulator()
@@ -0,0 +1,152 @@
+""" sorted_frame.py
+
+Dataframe wrapper which remembers whether its index is sorted
+"""
+import numpy as np
+import pandas as pd
+
+from date_tools import parse_bounds
+
+
+# ----------------------------------------------------------------------------
+#   The SortedFrame class
+# ----------------------------------------------------------------------------
+class SortedFrame:
+    """ Wraps a dataframe and records whether its row index is sorted.
+
+        Label slices are answered with `searchsorted` on the index. The
+        frame is only sorted when a slice is requested while the index is
+        not sorted, and the flag is kept through appends and renames.
+    """
+
+    def __init__(self, df, is_sorted=None):
+        self._df = df
+        # None means "unknown", checked the first time it is needed
+        self._is_sorted = is_sorted
+        # Sorted index values used by `searchsorted`, built on demand
+        self._keys = None
+
+    def __len__(self):
+        return len(self._df)
+
+    def __repr__(self):
+        return f'SortedFrame(is_sorted={self._is_sorted})\n{self._df!r}'
+
+    @property
+    def df(self):
+        """ The wrapped dataframe
+        """
+        return self._df
+
+    @property
+    def is_sorted(self):
+        """ True if the index is sorted in increasing order
+        """
+        if self._is_sorted is None:
+            self._is_sorted = bool(self._df.index.is_monotonic_increasing)
+        return self._is_sorted
+
+    def sort(self):
+        """ Sorts the frame on its index if needed and returns self
+        """
+        if not self.is_sorted:
+            self._df = self._df.sort_index(kind='stable')
+            self._is_sorted = True
+            self._keys = None
+        return self
+
+    def append(self, other):
+        """ Appends the rows of `other` (a dataframe or SortedFrame). The
+            result stays sorted if both parts are sorted and `other` starts
+            at or after the last label of this frame
+        """
+        if isinstance(other, SortedFrame):
+            other_sorted = other.is_sorted
+            other = other.df
+        else:
+            other_sorted = bool(other.index.is_monotonic_increasing)
+        if len(other) == 0:
+            return self
+        if len(self._df) == 0:
+            self._df, self._is_sorted = other, other_sorted
+            self._keys = None
+            return self
+
+        self._is_sorted = self.is_sorted and other_sorted \
+            and other.index[0] >= self._df.index[-1]
+        self._df = pd.concat([self._df, other])
+        self._keys = None
+        return self
+
+    def rename(self, columns=None, index=None):
+        """ Renames columns and/or index labels. Renaming columns keeps the
+            sorted flag, renaming index labels resets it to unknown
+        """
+        self._df = self._df.rename(columns=columns, index=index)
+        if index is not None:
+            self._is_sorted = None
+            self._keys = None
+        return self
+
+    # ------------------------------------------------------------------------
+    #   Label slices
+    # ------------------------------------------------------------------------
+    def _bound(self, label, pos):
+        """ Converts `label` to a value comparable with the index and the
+            `searchsorted` side giving the first (`pos` = 0) or one past the
+            last (`pos` = 1) row of the label. On a datetime index, partial
+            strings such as '2020-01' cover the whole period, like `df.loc`.
+            On a tz-aware index, strings and naive timestamps are wall times
+            in the timezone of the index
+        """
+        index = self._df.index
+        if isinstance(index, pd.DatetimeIndex):
+            bound = parse_bounds(label)[pos]
+            if index.tz is not None and (isinstance(label, str)
+                                         or pd.Timestamp(label).tz is None):
+                # The sorted keys are UTC nanoseconds
+                bound = pd.Timestamp(bound).tz_localize(
+                    index.tz, nonexistent='shift_forward').value
+            return np.datetime64(bound, 'ns'), 'left'
+        return label, 'left' if pos == 0 else 'right'
+
+    def _sorted_keys(self):
+        """ Returns the sorted index values, sorting the frame if needed
+        """
+        self.sort()
+        if self._keys is None:
+            index = self._df.index
+            if isinstance(index, pd.DatetimeIndex):
+                self._keys = index.as_unit('ns').asi8.view('datetime64[ns]')
+            else:
+                self._keys = index
+        return self._keys
+
+    def positions(self, start=None, end=None):
+        """ Returns the positions (i, j) such that `df.iloc[i:j]` has the
+            rows with labels between `start` and `end` (both included)
+        """
+        values = self._sorted_keys()
+        i, j = 0, len(values)
+        if start is not None:
+            bound, side = self._bound(start, 0)
+            i = int(values.searchsorted(bound, side=side))
+        if end is not None:
+            bound, side = self._bound(end, 1)
+            j = int(values.searchsorted(bound, side=side))
+        return i, max(i, j)
+
+    def slice(self, start=None, end=None):
+        """ Same as `df.loc[start:end]` on the sorted frame. Partial date
+            strings cover their whole period, so `sf['2020-01':'2020-02']`
+            includes every row in February
+        """
+        i, j = self.positions(start, end)
+        return self._df.iloc[i:j]
+
+    def __getitem__(self, key):
+        """ `sf[start:end]` --> label slice, anything else goes to `df.loc`
+        """
+        if isinstance(key, slice) and key.step is None:
+            return self.slice(key.start, key.stop)
+        return self._df.loc[key]